@@ -0,0 +1,289 @@
+"""
+Page/flow transition graph for a DFCX agent
+
+Built incrementally while load_agent_data parses routes, then summarised into
+the PageGraph and FlowGraph tables (reachability, loops and dead ends).
+
+Routes set on a flow follow DFCX scoping: routes with an intent and event
+handlers are in scope on every page of the flow, condition-only routes only
+on its start page. The same applies to route groups used by the flow.
+"""
+
+from collections import defaultdict, deque
+
+from table_schemas import present
+
+# The default start flow always has the nil UUID as its ID
+DEFAULT_START_FLOW = '00000000-0000-0000-0000-000000000000'
+END_SESSION = 'END_SESSION'
+# Special targets that leave the current page without pointing at a real page
+EXIT_TARGETS = ('END_FLOW', 'PREVIOUS_PAGE')
+
+
+def flow_of(resource_id):
+    """Return the flow ID a page or route group ID belongs to"""
+    for marker in ('/pages/', '/transitionRouteGroups/'):
+        if marker in resource_id:
+            return resource_id.split(marker)[0]
+    return resource_id
+
+
+def is_special(node_id):
+    return node_id == END_SESSION or node_id.split('/')[-1] in EXIT_TARGETS
+
+
+class AgentGraph:
+    def __init__(self):
+        self.page_names = {}  # page ID -> display name
+        self.page_flows = {}  # page ID -> flow ID
+        self.flow_names = {}  # flow ID -> display name
+        self.edges = defaultdict(set)  # page ID -> target node IDs
+        # flow ID -> targets of flow routes in scope on all of its pages
+        self.flow_targets = defaultdict(set)
+        # route group ID -> (target, in scope on all pages of a using flow)
+        self.group_targets = defaultdict(set)
+        self.group_usage = defaultdict(set)  # route group ID -> page IDs
+
+    def add_flow(self, flow_id, flow_name):
+        self.flow_names[flow_id] = flow_name
+        # The flow ID doubles as the ID of its start page
+        self.add_page(flow_id, flow_id, 'Start')
+
+    def add_page(self, page_id, flow_id, page_name):
+        self.page_names[page_id] = page_name
+        self.page_flows[page_id] = flow_id
+
+    def add_route_group_usage(self, page_id, route_group_ids):
+        for route_group_id in route_group_ids:
+            self.group_usage[route_group_id].add(page_id)
+
+    def add_routes(self, routes):
+        """Record the edges of a DataFrame produced by parse_routes"""
+        columns = ['pageId', 'routeGroupId', 'targetPageId', 'intentId',
+                   'event']
+        for page_id, route_group_id, target_id, intent_id, event in zip(
+                *(routes[column] for column in columns)):
+            if not present(target_id):
+                continue
+            flow_wide = present(intent_id) or present(event)
+            if present(route_group_id):
+                self.group_targets[route_group_id].add((target_id, flow_wide))
+            elif page_id in self.flow_names and flow_wide:
+                self.flow_targets[page_id].add(target_id)
+            elif present(page_id):
+                self.edges[page_id].add(
+                    self.resolve_target(page_id, target_id))
+
+    @staticmethod
+    def resolve_target(page_id, target_id):
+        """Map the symbolic page targets onto graph nodes"""
+        last = target_id.split('/')[-1]
+        if last == END_SESSION:
+            return END_SESSION
+        if last == 'CURRENT_PAGE':
+            return page_id
+        if last == 'START_PAGE':
+            return flow_of(target_id)
+        return target_id
+
+    def adjacency(self):
+        """Page adjacency with flow routes and route group routes expanded
+        onto the pages they are in scope on"""
+        adjacency = {page_id: set(targets)
+                     for page_id, targets in self.edges.items()}
+        flow_pages = defaultdict(list)
+        for page_id, flow_id in self.page_flows.items():
+            adjacency.setdefault(page_id, set())
+            flow_pages[flow_id].append(page_id)
+
+        def add_targets(page_ids, targets):
+            for page_id in page_ids:
+                for target_id in targets:
+                    adjacency.setdefault(page_id, set()).add(
+                        self.resolve_target(page_id, target_id))
+
+        for flow_id, targets in self.flow_targets.items():
+            add_targets(flow_pages[flow_id], targets)
+        for route_group_id, targets in self.group_targets.items():
+            for page_id in self.group_usage.get(route_group_id, ()):
+                for target_id, flow_wide in targets:
+                    if flow_wide and page_id in self.flow_names:
+                        add_targets(flow_pages[page_id], [target_id])
+                    else:
+                        add_targets([page_id], [target_id])
+        for targets in list(adjacency.values()):
+            for target_id in targets:
+                adjacency.setdefault(target_id, set())
+        return adjacency
+
+    def roots(self):
+        start_flows = [flow_id for flow_id in self.flow_names
+                       if flow_id.endswith('/flows/' + DEFAULT_START_FLOW)]
+        return start_flows or list(self.flow_names)
+
+    def analyze(self):
+        """Compute reachability, strongly connected components and dead ends.
+        Every pass is a single BFS/DFS, so the whole analysis is O(V + E)."""
+        adjacency = self.adjacency()
+        reverse = defaultdict(set)
+        for source, targets in adjacency.items():
+            for target in targets:
+                reverse[target].add(source)
+        component_ids, component_sizes = strongly_connected_components(
+            adjacency)
+        end_roots = [END_SESSION] if END_SESSION in adjacency else []
+        return {
+            'adjacency': adjacency,
+            'reverse': reverse,
+            'reachable': bfs(adjacency, self.roots()),
+            'reaches_end_session': bfs(reverse, end_roots),
+            'component_ids': component_ids,
+            'component_sizes': component_sizes,
+            'dead_ends': {node for node, targets in adjacency.items()
+                          if not targets and not is_special(node)},
+        }
+
+    def flow_of_page(self, page_id):
+        return self.page_flows.get(page_id, flow_of(page_id))
+
+    def to_tables(self, date, agent_id, agent_name):
+        """Return the PageGraph and FlowGraph table contents as dicts of
+        columns"""
+        analysis = self.analyze()
+        adjacency = analysis['adjacency']
+        reverse = analysis['reverse']
+        component_ids = analysis['component_ids']
+        component_sizes = analysis['component_sizes']
+
+        page_ids = [node for node in adjacency if not is_special(node)]
+        page_sizes = [component_sizes[component_ids[page_id]]
+                      for page_id in page_ids]
+        page_table = {
+            'date': [date for _ in page_ids],
+            'agentId': [agent_id for _ in page_ids],
+            'agentName': [agent_name for _ in page_ids],
+            'flowId': [self.flow_of_page(page_id) for page_id in page_ids],
+            'pageId': page_ids,
+            'pageName': [self.page_names.get(page_id, page_id.split('/')[-1])
+                         for page_id in page_ids],
+            'targetPageIds': [sorted(adjacency[page_id])
+                              for page_id in page_ids],
+            'inDegree': [len(reverse.get(page_id, ()))
+                         for page_id in page_ids],
+            'outDegree': [len(adjacency[page_id]) for page_id in page_ids],
+            'reachable': [page_id in analysis['reachable']
+                          for page_id in page_ids],
+            'reachesEndSession': [page_id in analysis['reaches_end_session']
+                                  for page_id in page_ids],
+            'isDeadEnd': [page_id in analysis['dead_ends']
+                          for page_id in page_ids],
+            'componentId': [component_ids[page_id] for page_id in page_ids],
+            'componentSize': page_sizes,
+            'inLoop': [size > 1 or page_id in adjacency[page_id]
+                       for page_id, size in zip(page_ids, page_sizes)],
+        }
+
+        # Collapse the page graph onto flows
+        flow_edges = defaultdict(set)
+        for page_id in page_ids:
+            source_flow = self.flow_of_page(page_id)
+            for target_id in adjacency[page_id]:
+                if is_special(target_id):
+                    continue
+                target_flow = self.flow_of_page(target_id)
+                if target_flow != source_flow:
+                    flow_edges[source_flow].add(target_flow)
+        flow_ids = list(self.flow_names)
+        for flow_id in flow_ids:
+            flow_edges.setdefault(flow_id, set())
+        flow_component_ids, flow_component_sizes = \
+            strongly_connected_components(flow_edges)
+        flows_reaching_end = {self.flow_of_page(page_id)
+                              for page_id in analysis['reaches_end_session']
+                              if not is_special(page_id)}
+        dead_end_counts = defaultdict(int)
+        for page_id in analysis['dead_ends']:
+            dead_end_counts[self.flow_of_page(page_id)] += 1
+        flow_table = {
+            'date': [date for _ in flow_ids],
+            'agentId': [agent_id for _ in flow_ids],
+            'agentName': [agent_name for _ in flow_ids],
+            'flowId': flow_ids,
+            'flowName': [self.flow_names[flow_id] for flow_id in flow_ids],
+            'targetFlowIds': [sorted(flow_edges[flow_id])
+                              for flow_id in flow_ids],
+            'reachable': [flow_id in analysis['reachable']
+                          for flow_id in flow_ids],
+            'reachesEndSession': [flow_id in flows_reaching_end
+                                  for flow_id in flow_ids],
+            'deadEndPages': [dead_end_counts[flow_id] for flow_id in flow_ids],
+            'componentId': [flow_component_ids[flow_id]
+                            for flow_id in flow_ids],
+            'inLoop': [flow_component_sizes[flow_component_ids[flow_id]] > 1
+                       for flow_id in flow_ids],
+        }
+        return page_table, flow_table
+
+
+def bfs(adjacency, roots):
+    seen = set(roots)
+    queue = deque(roots)
+    while queue:
+        node = queue.popleft()
+        for target in adjacency.get(node, ()):
+            if target not in seen:
+                seen.add(target)
+                queue.append(target)
+    return seen
+
+
+def strongly_connected_components(adjacency):
+    """Iterative Tarjan. Returns (node -> component ID,
+    component ID -> size)"""
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    component_ids = {}
+    component_sizes = []
+    counter = 0
+    for root in adjacency:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(adjacency.get(root, ())))]
+        while work:
+            node, targets = work[-1]
+            advanced = False
+            for target in targets:
+                if target not in index:
+                    index[target] = lowlink[target] = counter
+                    counter += 1
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(adjacency.get(target, ()))))
+                    advanced = True
+                    break
+                if target in on_stack:
+                    lowlink[node] = min(lowlink[node], index[target])
+            if advanced:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                lowlink[parent] = min(lowlink[parent], lowlink[node])
+            if lowlink[node] == index[node]:
+                component_id = len(component_sizes)
+                size = 0
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component_ids[member] = component_id
+                    size += 1
+                    if member == node:
+                        break
+                component_sizes.append(size)
+    return component_ids, component_sizes
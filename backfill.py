@@ -0,0 +1,195 @@
+"""
+Batch backfill of agent structure
+
+Runs load_agent_data for every agent in a file across a worker pool and
+writes the results to local Parquet files or BigQuery, e.g.
+
+    python backfill.py agents.json --workers 8 --sink local --output-dir out/
+
+The agents file is a JSON array (or JSON lines) of the same entries as the
+Pub/Sub message: agent_id, agent_location, agent_project_id and, for the
+BigQuery sink, bq_project_id (and optionally storage_mode).
+"""
+
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
+import pandas as pd
+from tabulate import tabulate
+
+import main
+from memory_budget import (DEFAULT_BUDGET_MB, MB, SpillableTable,
+                           cleanup_spilled, trace_enabled)
+from rate_limit import limiter_stats, throttled
+
+
+def read_agents(path):
+    with open(path) as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def count_rows(agent_data):
+    return sum(table.shape[0] for table in agent_data.values()
+               if isinstance(table, (pd.DataFrame, SpillableTable)))
+
+
+def extract_agent(agent, sink, output_dir, memory_budget_mb,
+                  build_text_index=main.DEFAULT_TEXT_INDEX, trace_memory=None):
+    """Load and write one agent. Returns a timing/result dict; errors are
+    reported in the result rather than raised so one agent can't stop the
+    run"""
+    full_agent_path = (f"projects/{agent['agent_project_id']}"
+                       f"/locations/{agent['agent_location']}"
+                       f"/agents/{agent['agent_id']}")
+    result = {'agent': full_agent_path, 'name': None, 'status': 'ok',
+              'rows': 0, 'load_s': 0.0, 'write_s': 0.0, 'total_s': 0.0,
+              'output': None, 'error': None}
+    started = time.monotonic()
+    agent_data = None
+    try:
+        dfcx_a = throttled(main.Agents(), full_agent_path)
+        result['name'] = dfcx_a.get_agent(
+            agent_id=full_agent_path).display_name
+        agent_data = main.load_agent_data(
+            full_agent_path, result['name'], memory_budget_mb,
+            build_text_index, trace_memory)
+        result['rows'] = count_rows(agent_data)
+        loaded = time.monotonic()
+        result['load_s'] = loaded - started
+
+        if sink == 'local':
+            result['output'] = main.write_to_local(
+                agent_data, output_dir, full_agent_path)
+        elif (agent.get('storage_mode', main.DEFAULT_STORAGE_MODE)
+              == 'content_addressed'):
+            main.write_content_addressed(
+                agent_data, agent['bq_project_id'], full_agent_path,
+                result['name'])
+            result['output'] = agent['bq_project_id']
+        else:
+            main.write_to_bq(agent_data, agent['bq_project_id'])
+            result['output'] = agent['bq_project_id']
+        result['write_s'] = time.monotonic() - loaded
+    except Exception as e:
+        print(f"Error: {full_agent_path}: {e}")
+        result['status'] = 'error'
+        result['error'] = str(e)
+    finally:
+        if agent_data is not None:
+            cleanup_spilled(agent_data)
+    result['total_s'] = time.monotonic() - started
+    return result
+
+
+def run(agents, sink, output_dir, workers, executor, memory_budget_mb,
+        build_text_index=main.DEFAULT_TEXT_INDEX):
+    if executor == 'process':
+        pool_class = ProcessPoolExecutor
+    else:
+        pool_class = ThreadPoolExecutor
+    # tracemalloc is process-wide: worker threads must not start or stop it
+    # per agent, so a thread run traces once around the whole pool
+    trace_memory = None if executor == 'process' else False
+    shared_trace = (executor != 'process' and trace_enabled(memory_budget_mb)
+                    and not tracemalloc.is_tracing())
+    if shared_trace:
+        tracemalloc.start()
+    results = []
+    total_rows = 0
+    started = time.monotonic()
+    try:
+        with pool_class(max_workers=workers) as pool:
+            futures = [pool.submit(extract_agent, agent, sink, output_dir,
+                                   memory_budget_mb, build_text_index,
+                                   trace_memory)
+                       for agent in agents]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                total_rows += result['rows']
+                elapsed = time.monotonic() - started
+                print(f"[{len(results)}/{len(agents)}] {result['status']} "
+                      f"{result['name'] or result['agent']} "
+                      f"in {result['total_s']:.1f}s | "
+                      f"{len(results) / elapsed * 60:.1f} agents/min, "
+                      f"{total_rows / elapsed:.0f} rows/s", flush=True)
+    finally:
+        if shared_trace:
+            peak = tracemalloc.get_traced_memory()[1] / MB
+            tracemalloc.stop()
+            print(f"Peak traced memory across agents: {peak:.1f} MB")
+    return results, time.monotonic() - started
+
+
+def print_summary(results, elapsed):
+    rows = [[r['name'] or r['agent'], r['status'], r['rows'],
+             f"{r['load_s']:.1f}", f"{r['write_s']:.1f}",
+             f"{r['total_s']:.1f}", r['error'] or r['output']]
+            for r in sorted(results, key=lambda r: r['total_s'],
+                            reverse=True)]
+    print(tabulate(rows, headers=['agent', 'status', 'rows', 'load s',
+                                  'write s', 'total s', 'output / error']))
+    failed = sum(1 for r in results if r['status'] != 'ok')
+    print(f"{len(results) - failed} succeeded, {failed} failed, "
+          f"{sum(r['rows'] for r in results)} rows in {elapsed:.1f}s "
+          f"({len(results) / elapsed * 60 if elapsed else 0:.1f} "
+          "agents/min)")
+    return failed
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    parser.add_argument('agents_file',
+                        help='JSON array or JSON lines of agent entries')
+    parser.add_argument('--sink', choices=['local', 'bigquery'],
+                        default='local',
+                        help='where to write the tables (default: local)')
+    parser.add_argument('--output-dir', default='agent_structure_output',
+                        help='root directory for the local sink')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of agents extracted concurrently')
+    parser.add_argument('--executor', choices=['thread', 'process'],
+                        default='thread',
+                        help='worker pool type; process isolates memory per '
+                             'agent but each process gets its own DFCX rate '
+                             'limiter')
+    parser.add_argument('--memory-budget-mb', type=float,
+                        default=DEFAULT_BUDGET_MB,
+                        help='per-agent memory budget before spilling to disk')
+    parser.add_argument('--text-index', action='store_true',
+                        default=main.DEFAULT_TEXT_INDEX,
+                        help='also build the text_index table '
+                             '(default: BUILD_TEXT_INDEX)')
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    agents = read_agents(args.agents_file)
+    if args.sink == 'bigquery':
+        missing = [a['agent_id'] for a in agents if 'bq_project_id' not in a]
+        if missing:
+            print(f"Error: bq_project_id missing for agents {missing}")
+            return 2
+    print(f"Backfilling {len(agents)} agents with {args.workers} "
+          f"{args.executor} workers to {args.sink}")
+    results, elapsed = run(agents, args.sink, args.output_dir,
+                           args.workers, args.executor, args.memory_budget_mb,
+                           args.text_index)
+    failed = print_summary(results, elapsed)
+    if args.executor == 'thread':
+        print('DFCX rate limiter:', limiter_stats())
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,187 @@
+"""
+Content-addressed storage of agent structure
+
+Every row of the structure tables is normalised (snapshot date, agent name and
+the agent's own resource path prefix removed) and keyed by a hash of that
+content. Identical pages, routes, intents etc. across environments and across
+snapshots are stored once in agent_structure.objects; each snapshot only adds
+thin agent_structure.object_membership rows pointing at those hashes.
+
+New objects are loaded into a per-write staging table and MERGEd into the
+objects table on contentHash, so concurrent writers of the same content never
+store it twice.
+"""
+
+import hashlib
+import json
+import math
+import uuid
+
+import pandas as pd
+import pandas_gbq
+from google.api_core import exceptions as core_exceptions
+from google.cloud import bigquery
+
+from memory_budget import iter_frames
+from table_schemas import bq_schema
+
+# Columns identifying a row within one agent snapshot, per table
+TABLE_KEYS = {
+    'Flows': ['flowId'],
+    'Pages': ['pageId'],
+    'TransitionRoutes': ['pageId', 'routeGroupId', 'parameterId',
+                         'transitionRouteId'],
+    'RouteGroups': ['routeGroupId'],
+    'Parameters': ['parameterId'],
+    'Intents': ['intentId'],
+    'TrainingPhrases': ['intentId', 'annotatedPhrase'],
+    'Entities': ['entityTypeId', 'entity', 'synonym'],
+    'Webhooks': ['webhookId'],
+}
+SNAPSHOT_COLUMNS = ('date', 'agentId', 'agentName')
+AGENT_PLACEHOLDER = '{agent}'
+
+OBJECTS_TABLE_ID = 'agent_structure.objects'
+MEMBERSHIP_TABLE_ID = 'agent_structure.object_membership'
+# Hashes per lookup query, well below the query parameter size limit
+LOOKUP_BATCH = 10000
+# Attempts of the objects MERGE when another writer's DML conflicts with it
+MERGE_ATTEMPTS = 3
+
+
+def normalize_value(value, agent_id):
+    if isinstance(value, str):
+        if not agent_id:
+            # ''.replace would put the placeholder between every character
+            return value
+        return value.replace(agent_id, AGENT_PLACEHOLDER)
+    if hasattr(value, 'tolist'):  # numpy arrays and scalars
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [normalize_value(item, agent_id) for item in value]
+    if value is None or value is pd.NA or (
+            isinstance(value, float) and math.isnan(value)):
+        return None
+    return value
+
+
+def normalize_row(row, agent_id):
+    return {column: normalize_value(value, agent_id)
+            for column, value in row.items() if column not in SNAPSHOT_COLUMNS}
+
+
+def content_hash(content):
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def expand_content(content, agent_id):
+    """Turn a stored object back into a row for agent_id"""
+    return json.loads(content.replace(AGENT_PLACEHOLDER, agent_id))
+
+
+def split_snapshot(agent_data, date, agent_id, agent_name):
+    """Return (objects, membership) dicts of columns for one agent snapshot.
+    objects holds each distinct normalised row once."""
+    objects = {'contentHash': [], 'tableName': [], 'content': [], 'date': []}
+    membership = {'date': [], 'agentId': [], 'agentName': [], 'tableName': [],
+                  'objectKey': [], 'contentHash': []}
+    seen = set()
+    for table_name, key_columns in TABLE_KEYS.items():
+        for chunk in iter_frames(agent_data[table_name]):
+            for row in chunk.to_dict('records'):
+                normalized = normalize_row(row, agent_id)
+                content = json.dumps(normalized, sort_keys=True,
+                                     separators=(',', ':'), default=str)
+                row_hash = content_hash(table_name + '\n' + content)
+                if row_hash not in seen:
+                    seen.add(row_hash)
+                    objects['contentHash'].append(row_hash)
+                    objects['tableName'].append(table_name)
+                    objects['content'].append(content)
+                    objects['date'].append(date)
+                membership['date'].append(date)
+                membership['agentId'].append(agent_id)
+                membership['agentName'].append(agent_name)
+                membership['tableName'].append(table_name)
+                membership['objectKey'].append('|'.join(
+                    str(normalized[column]) for column in key_columns
+                    if normalized[column] is not None))
+                membership['contentHash'].append(row_hash)
+    return objects, membership
+
+
+class BigQueryContentStore:
+    """Looks up which hashes agent_structure.objects already holds and adds
+    new objects. Hashes seen by this process are remembered, so warm
+    instances skip the lookup."""
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.client = bigquery.Client(project=project_id)
+        self.known = set()
+
+    def existing(self, hashes):
+        unknown = [h for h in hashes if h not in self.known]
+        query = f"""
+            SELECT DISTINCT contentHash
+            FROM `{OBJECTS_TABLE_ID}`
+            WHERE contentHash IN UNNEST(@hashes)
+        """
+        for start in range(0, len(unknown), LOOKUP_BATCH):
+            config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ArrayQueryParameter(
+                    'hashes', 'STRING', unknown[start:start + LOOKUP_BATCH])])
+            try:
+                rows = self.client.query(query, job_config=config).result()
+            except core_exceptions.NotFound:
+                # Objects table doesn't exist before the first write
+                print(f"{OBJECTS_TABLE_ID} not found, all objects are new")
+                break
+            self.known.update(row.contentHash for row in rows)
+        return {h for h in hashes if h in self.known}
+
+    def write(self, objects_df):
+        """Add objects_df to the objects table, skipping hashes another
+        writer stored since the lookup"""
+        staging_id = f"{OBJECTS_TABLE_ID}_staging_{uuid.uuid4().hex}"
+        pandas_gbq.to_gbq(objects_df, staging_id, project_id=self.project_id,
+                          if_exists='fail', table_schema=bq_schema('Objects'),
+                          progress_bar=False)
+        try:
+            self.client.query(f"""
+                CREATE TABLE IF NOT EXISTS `{OBJECTS_TABLE_ID}`
+                LIKE `{staging_id}`
+            """).result()
+            # The UPDATE clause (keeping the first date an object was seen)
+            # makes this a mutating MERGE, which BigQuery serialises against
+            # other writers; an insert-only MERGE would run concurrently
+            merge = f"""
+                MERGE `{OBJECTS_TABLE_ID}` T
+                USING `{staging_id}` S
+                ON T.contentHash = S.contentHash
+                WHEN MATCHED AND S.date < T.date THEN
+                    UPDATE SET date = S.date
+                WHEN NOT MATCHED THEN
+                    INSERT ROW
+            """
+            for attempt in range(MERGE_ATTEMPTS):
+                try:
+                    self.client.query(merge).result()
+                    break
+                except core_exceptions.BadRequest as e:
+                    if ('concurrent update' not in str(e)
+                            or attempt == MERGE_ATTEMPTS - 1):
+                        raise
+                    print(f"Retrying {OBJECTS_TABLE_ID} merge: {e}")
+        finally:
+            self.client.delete_table(staging_id, not_found_ok=True)
+        self.known.update(objects_df['contentHash'])
+
+
+_stores = {}
+
+
+def get_content_store(project_id):
+    if project_id not in _stores:
+        _stores[project_id] = BigQueryContentStore(project_id)
+    return _stores[project_id]
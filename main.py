@@ -16,6 +16,16 @@ from dfcx_scrapi.core.webhooks import Webhooks
 from dfcx_scrapi.core.transition_route_groups import TransitionRouteGroups
 from proto.marshal.collections.maps import MapComposite
 from proto.marshal.collections.repeated import RepeatedComposite
+import os
+from agent_graph import AgentGraph
+from memory_budget import DEFAULT_BUDGET_MB, MemoryMonitor, SpillableTable, cleanup_spilled, iter_frames
+from content_store import MEMBERSHIP_TABLE_ID, OBJECTS_TABLE_ID, get_content_store, split_snapshot
+from rate_limit import throttled, limiter_stats
+from reference_index import ReferenceIndex
+from table_schemas import bq_schema, build_frame, concat_frames, parquet_schema, preparer, raw_frame
+from text_index import DEFAULT_ENABLED as DEFAULT_TEXT_INDEX, TextIndex
+from trigger_state import (DEFAULT_PRECHECK, DEFAULT_STATE_STORE, DEFAULT_WINDOW_SECONDS,
+                           agent_fingerprint, agent_key, dedupe_agents, get_state_store)
 
 # Type aliases
 DFCXFlow = dfcx_types.flow.Flow
@@ -30,34 +40,64 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-# Get current date
-curr_date = str(datetime.now())
-
+# Get current date (the DATETIME date column of every table)
+curr_date = pd.Timestamp(datetime.now())
+
+# 'tables' writes full per-snapshot tables, 'content_addressed' writes each
+# distinct object once plus per-snapshot membership rows
+DEFAULT_STORAGE_MODE = os.environ.get('STORAGE_MODE', 'tables')
+
+# agent_data keys -> table names (BigQuery tables and local sink directories)
+TABLE_NAMES = {
+    'Intents': 'intents',
+    'TrainingPhrases': 'training_phrases',
+    'Entities': 'entity_types',
+    'Webhooks': 'webhooks',
+    'Pages': 'pages',
+    'Flows': 'flows',
+    'TransitionRoutes': 'transition_routes',
+    'RouteGroups': 'transition_route_groups',
+    'Parameters': 'parameters',
+    'PageGraph': 'page_graph',
+    'FlowGraph': 'flow_graph',
+    'References': 'references',
+    'TextTerms': 'text_index',
+    'RunReport': 'run_report',
+}
+
+
+def fetch_agent_resources(agent_id):
+    """List every resource the extraction reads, once: flows, pages and route
+    groups per flow name, intents, entity types and webhooks. Shared by the
+    trigger precheck (trigger_state.agent_fingerprint takes the same keys) and
+    load_agent_data, so a precheck that finds changes costs no extra reads."""
+    dfcx_flows = throttled(Flows(agent_id=agent_id), agent_id)
+    dfcx_pages = throttled(Pages(), agent_id)
+    dfcx_route_groups = throttled(TransitionRouteGroups(
+        agent_id=agent_id
+    ), agent_id)
+    dfcx_webhooks = throttled(Webhooks(agent_id=agent_id), agent_id)
+    dfcx_intents = throttled(Intents(agent_id=agent_id), agent_id)
+    dfcx_entities = throttled(EntityTypes(agent_id=agent_id), agent_id)
 
-def get_all_flow_data(dfcx_flows, agent_id):
-    flow_data = {}
     flow_list = dfcx_flows.list_flows(agent_id)
-    for flow in flow_list:
-        flow_data[flow.name] = flow
-    return flow_data
-
-
-def get_all_page_data(flows_map, dfcx_pages):
-    page_data = {}
-    for flow_id in flows_map.keys():
-        page_list = dfcx_pages.list_pages(flow_id=flow_id)
-        page_data[flow_id] = {page.name: page for page in page_list}
-    return page_data
+    return {
+        'flows': flow_list,
+        'pages': {flow.name: dfcx_pages.list_pages(flow_id=flow.name)
+                  for flow in flow_list},
+        'route_groups': {
+            flow.name: dfcx_route_groups.list_transition_route_groups(
+                flow_id=flow.name)
+            for flow in flow_list},
+        'intents': dfcx_intents.list_intents(agent_id=agent_id),
+        'entity_types': dfcx_entities.list_entity_types(agent_id=agent_id),
+        'webhooks': dfcx_webhooks.list_webhooks(agent_id=agent_id),
+    }
 
 
-def get_all_route_group_data(flows_map, dfcx_route_groups):
-    route_group_data = {}
-    for flow_id in flows_map.keys():
-        group_list = dfcx_route_groups.list_transition_route_groups(
-            flow_id=flow_id
-        )
-        route_group_data[flow_id] = {rg.name: rg for rg in group_list}
-    return route_group_data
+def name_map(resources):
+    """ID -> display name, like scrapi's get_*_map but without listing again"""
+    return {resource.name: resource.display_name for resource in resources}
 
 
 def parse_value(value):
@@ -212,8 +252,6 @@ def parse_conditional_fulfillment(conditional_response, cond_res_text='', tabs=0
 
 def parse_routes(route_list, agent_id, agent_name, flow_id, flow_dict, page_dict, route_group_dict, webhook_dict, intent_dict, page_id=None, route_group_id=None, parameter_id=None, parameter_name=None):
     routes = []
-    routes.append(pd.DataFrame(columns=['date', 'agentId', 'agentName', 'flowId', 'flowName', 'pageId', 'pageName', 'transitionRouteId', 'routeGroupId', 'routeGroupName', 'intentId', 'intentName',
-                  'parameterId', 'parameterName', 'targetPageId', 'targetPageName', 'webhookId', 'webhookName', 'webhookTag', 'event', 'condition',  'fulfillment',  'partialResponse', 'parameterPresets']))
     for route in route_list:
         fulfillment = parse_fulfillment(
             route.trigger_fulfillment, webhook_dict)
@@ -230,43 +268,38 @@ def parse_routes(route_list, agent_id, agent_name, flow_id, flow_dict, page_dict
                 target_page_name = page_dict[flow_id][target_page_id]
             else:
                 target_page_name = target_page_id.split("/")[-1]
-        route_df = pd.DataFrame({
-            'date': [curr_date],
-            'agentId': [agent_id],
-            'agentName': [agent_name],
-            'flowId': [flow_id],
-            'flowName': [flow_dict[flow_id]],
-            'pageId': [page_id],
-            'pageName': [map_page_name(flow_id, page_id, page_dict)],
-            'transitionRouteId': [route.name],
-            'routeGroupId': [route_group_id],
-            'routeGroupName': [route_group_dict[flow_id][route_group_id] if flow_id in route_group_dict and route_group_id in route_group_dict[flow_id] else None],
-            'intentId': [getattr(route, 'intent', None)],
-            'intentName': [intent_dict[getattr(route, 'intent', None)] if getattr(route, 'intent', None) in intent_dict else None],
-            'parameterId': [parameter_id],
-            'parameterName': [parameter_name],
-            'targetPageId': [target_page_id],
-            'targetPageName': [target_page_name],
-            'webhookId': [fulfillment['webhookId']],
-            'webhookName': [fulfillment['webhookName']],
-            'webhookTag': [fulfillment['webhookTag']],
-            'event': [getattr(route, 'event', None)],
-            'condition': [getattr(route, 'condition', None)],
-            'fulfillment': [fulfillment['messages']],
-            'partialResponse': [fulfillment['partialResponse']],
-            'parameterPresets': [fulfillment['parameterPresets']]
+        routes.append({
+            'date': curr_date,
+            'agentId': agent_id,
+            'agentName': agent_name,
+            'flowId': flow_id,
+            'flowName': flow_dict[flow_id],
+            'pageId': page_id,
+            'pageName': map_page_name(flow_id, page_id, page_dict),
+            'transitionRouteId': route.name,
+            'routeGroupId': route_group_id,
+            'routeGroupName': route_group_dict[flow_id][route_group_id] if flow_id in route_group_dict and route_group_id in route_group_dict[flow_id] else None,
+            'intentId': getattr(route, 'intent', None),
+            'intentName': intent_dict[getattr(route, 'intent', None)] if getattr(route, 'intent', None) in intent_dict else None,
+            'parameterId': parameter_id,
+            'parameterName': parameter_name,
+            'targetPageId': target_page_id,
+            'targetPageName': target_page_name,
+            'webhookId': fulfillment['webhookId'],
+            'webhookName': fulfillment['webhookName'],
+            'webhookTag': fulfillment['webhookTag'],
+            'event': getattr(route, 'event', None),
+            'condition': getattr(route, 'condition', None),
+            'fulfillment': fulfillment['messages'],
+            'partialResponse': fulfillment['partialResponse'],
+            'parameterPresets': fulfillment['parameterPresets']
         })
-        routes.append(route_df)
-    return pd.concat(routes)
+    return raw_frame('TransitionRoutes', routes)
 
 
 def parse_parameters(form, agent_id, agent_name, flow_id, page_id, flow_dict, page_dict, route_group_dict, webhook_dict, intent_dict, entity_dict):
     parameters = []
-    parameter_routes = []
-    parameters.append(pd.DataFrame(columns=['date', 'agentId', 'agentName', 'flowId', 'flowName', 'pageId', 'pageName', 'parameterId', 'parameterName', 'entityId',
-                      'entityName', 'webhookId', 'webhookName', 'webhookTag', 'required', 'isList', 'redactInLog', 'fulfillment', 'partialResponse', 'parameterPresets', 'routes']))
-    parameter_routes.append(pd.DataFrame(columns=['date', 'agentId', 'agentName', 'flowId', 'flowName', 'pageId', 'pageName', 'transitionRouteId', 'routeGroupId', 'routeGroupName', 'intentId', 'intentName',
-                            'parameterId', 'parameterName', 'targetPageId', 'targetPageName', 'webhookId', 'webhookName', 'webhookTag', 'event', 'condition',  'fulfillment',  'partialResponse', 'parameterPresets']))
+    parameter_routes = [raw_frame('TransitionRoutes')]
     for parameter in form.parameters:
         # Composite since there isn't one in CX
         parameter_id = page_id + '/' + parameter.display_name
@@ -279,104 +312,121 @@ def parse_parameters(form, agent_id, agent_name, flow_id, page_id, flow_dict, pa
         entity_id = parameter.entity_type
         entity_name = entity_dict[entity_id] if entity_id in entity_dict else entity_id.split(
             "/")[-1]
-        parameter_df = pd.DataFrame({
-            'date': [curr_date],
-            'agentId': [agent_id],
-            'agentName': [agent_name],
-            'flowId': [flow_id],
-            'flowName': [flow_dict[flow_id]],
-            'pageId': [page_id],
-            'pageName': [map_page_name(flow_id, page_id, page_dict)],
-            'parameterId': [parameter_id],
-            'parameterName': [parameter.display_name],
-            'entityId': [entity_id],
-            'entityName': [entity_name],
-            'webhookId': [fulfillment['webhookId']],
-            'webhookName': [fulfillment['webhookName']],
-            'webhookTag': [fulfillment['webhookTag']],
-            'required': [getattr(parameter, 'required', False)],
-            'isList': [getattr(parameter, 'is_list', False)],
-            'redactInLog': [getattr(parameter, 'redact_in_log', False)],
-            'fulfillment': [fulfillment['messages']],
-            'partialResponse': [fulfillment['partialResponse']],
-            'parameterPresets': [fulfillment['parameterPresets']],
-            # 'dtmfEnabled': [False], # This actually isn't accessible in scrapi, apparently
-            'routes': [route_ids]
+        parameters.append({
+            'date': curr_date,
+            'agentId': agent_id,
+            'agentName': agent_name,
+            'flowId': flow_id,
+            'flowName': flow_dict[flow_id],
+            'pageId': page_id,
+            'pageName': map_page_name(flow_id, page_id, page_dict),
+            'parameterId': parameter_id,
+            'parameterName': parameter.display_name,
+            'entityId': entity_id,
+            'entityName': entity_name,
+            'webhookId': fulfillment['webhookId'],
+            'webhookName': fulfillment['webhookName'],
+            'webhookTag': fulfillment['webhookTag'],
+            'required': getattr(parameter, 'required', False),
+            'isList': getattr(parameter, 'is_list', False),
+            'redactInLog': getattr(parameter, 'redact_in_log', False),
+            'fulfillment': fulfillment['messages'],
+            'partialResponse': fulfillment['partialResponse'],
+            'parameterPresets': fulfillment['parameterPresets'],
+            # 'dtmfEnabled': False, # This actually isn't accessible in scrapi, apparently
+            'routes': route_ids
         })
-        parameters.append(parameter_df)
-    return pd.concat(parameters), pd.concat(parameter_routes)
+    return raw_frame('Parameters', parameters), pd.concat(parameter_routes)
 
 
-def load_agent_data(agent_id, agent_name):
-    print("Initializing Scrapi...")
+def collect_routes(routes, route_batches, collectors):
+    """Keep a parse_routes batch and feed it to the graph/index collectors"""
+    route_batches.append(routes)
+    for collector in collectors:
+        collector.add_routes(routes)
 
-    # Initialize scrapi
-    dfcx_flows = Flows(agent_id=agent_id)
-    dfcx_pages = Pages()
-    dfcx_route_groups = TransitionRouteGroups(
-        agent_id=agent_id
-    )
-    dfcx_webhooks = Webhooks(agent_id=agent_id)
-    dfcx_intents = Intents(agent_id=agent_id)
-    dfcx_entities = EntityTypes(agent_id=agent_id)
 
-    print("Generating maps...")
+def training_phrase_batch(agent_id, agent_name, intent_ids, intent_display_names, phrases, annotated_phrases):
+    tp_count = len(phrases)
+    return raw_frame('TrainingPhrases', {
+        'date': [curr_date for _ in range(tp_count)],
+        'agentId': [agent_id for _ in range(tp_count)],
+        'agentName': [agent_name for _ in range(tp_count)],
+        'intentId': intent_ids,
+        'intentName': intent_display_names,
+        'phrase': phrases,
+        'annotatedPhrase': annotated_phrases
+    })
+
+
+# Training phrases are handed to the spillable table in batches of this size
+TP_BATCH_ROWS = 5000
+
 
-    # Generate maps
-    flows_map = dfcx_flows.get_flows_map(agent_id=agent_id)
-    # flows_map_rev = dfcx_flows.get_flows_map(
-    #    agent_id=agent_id, reverse=True
-    # )
-    pages_map = {}
-    for flow_id in flows_map.keys():
-        pages_map[flow_id] = dfcx_pages.get_pages_map(flow_id=flow_id)
-    # pages_map_rev = {}
-    # for flow_id in flows_map.keys():
-    #    pages_map_rev[flow_id] = dfcx_pages.get_pages_map(
-    #        flow_id=flow_id, reverse=True
-    #    )
-    route_groups_map = {}
-    for fid in flows_map.keys():
-        route_groups_map[fid] = dfcx_route_groups.get_route_groups_map(
-            flow_id=fid
-        )
-    webhooks_map = dfcx_webhooks.get_webhooks_map(agent_id=agent_id)
-    intents_map = dfcx_intents.get_intents_map(agent_id=agent_id)
-    # intents_map_rev = dfcx_intents.get_intents_map(
-    #     agent_id=agent_id, reverse=True)
-    entities_map = dfcx_entities.get_entities_map(agent_id=agent_id)
+def load_agent_data(agent_id, agent_name, memory_budget_mb=DEFAULT_BUDGET_MB, build_text_index=DEFAULT_TEXT_INDEX,
+                    trace_memory=None, resources=None):
+    print("Initializing Scrapi...")
+    monitor = MemoryMonitor(memory_budget_mb, trace_memory)
+    text_index = TextIndex() if build_text_index else None
+
+    # Initialize scrapi (all calls share the project/region read quota limiter)
+    dfcx_intents = throttled(Intents(agent_id=agent_id), agent_id)
 
     print("Loading agent data...")
 
-    # Get CX object data
-    flow_data = get_all_flow_data(dfcx_flows, agent_id)
-    page_data = get_all_page_data(flows_map, dfcx_pages)
-    route_group_data = get_all_route_group_data(flows_map, dfcx_route_groups)
-    webhook_data = dfcx_webhooks.list_webhooks(agent_id=agent_id)
-    intent_data = dfcx_intents.list_intents(agent_id=agent_id)
-    entity_data = dfcx_entities.list_entity_types(agent_id=agent_id)
+    # Get CX object data, unless the trigger precheck already listed it
+    if resources is None:
+        resources = fetch_agent_resources(agent_id)
+    flow_data = {flow.name: flow for flow in resources['flows']}
+    page_data = {flow_id: {page.name: page for page in pages}
+                 for flow_id, pages in resources['pages'].items()}
+    route_group_data = {flow_id: {rg.name: rg for rg in groups}
+                        for flow_id, groups in resources['route_groups'].items()}
+    webhook_data = resources['webhooks']
+    intent_data = resources['intents']
+    entity_data = resources['entity_types']
 
     print("Agent data loaded.")
+    print('DFCX rate limiter:', limiter_stats())
+    monitor.checkpoint('fetch')
+
+    print("Generating maps...")
+
+    # Generate maps from the listed resources
+    flows_map = name_map(resources['flows'])
+    pages_map = {flow_id: name_map(pages)
+                 for flow_id, pages in resources['pages'].items()}
+    route_groups_map = {flow_id: name_map(groups)
+                        for flow_id, groups in resources['route_groups'].items()}
+    webhooks_map = name_map(webhook_data)
+    intents_map = name_map(intent_data)
+    entities_map = name_map(entity_data)
+    monitor.checkpoint('maps')
 
     # Next, process these into flat tables
-    intent_df = pd.concat([pd.DataFrame({
-        'date': [curr_date],
-        'agentId': [agent_id],
-        'agentName': [agent_name],
-        'intentId': [data.name],
-        'intentName': [data.display_name],
-        'description': [data.description],
-        'parameters': [[json.dumps({"id": param.id, "entity_type": param.entity_type, "is_list": param.is_list}) for param in data.parameters]],
-        'labels': [list(data.labels.keys())]
-    }) for data in intent_data])
-    intent_df['date'] = pd.to_datetime(intent_df['date'])
+    intent_df = build_frame('Intents', [{
+        'date': curr_date,
+        'agentId': agent_id,
+        'agentName': agent_name,
+        'intentId': data.name,
+        'intentName': data.display_name,
+        'description': data.description,
+        'parameters': [json.dumps({"id": param.id, "entity_type": param.entity_type, "is_list": param.is_list}) for param in data.parameters],
+        'labels': list(data.labels.keys())
+    } for data in intent_data])
+    ref_index = ReferenceIndex()
+    for data in intent_data:
+        ref_index.add_intent(data)
     print('Intents:', intent_df.shape)
+    monitor.checkpoint('intents')
 
     # Get all training phrases (with annotations)
     # First get the full training phrase data, which is split into parts (so more rows than the number of phrases)
     intents_df = dfcx_intents.bulk_intent_to_df(agent_id, mode='advanced')
 
     # Process the training phrase parts
+    tp_table = SpillableTable(
+        'TrainingPhrases', monitor, preparer('TrainingPhrases'))
     intent_ids = []
     intent_display_names = []
     phrases = []
@@ -393,6 +443,13 @@ def load_agent_data(agent_id, agent_name):
                 intent_display_names.append(current_intent_display_name)
                 phrases.append(current_phrase.strip())
                 annotated_phrases.append(current_annotated_phrase.strip())
+                if len(phrases) >= TP_BATCH_ROWS:
+                    tp_batch = training_phrase_batch(
+                        agent_id, agent_name, intent_ids, intent_display_names, phrases, annotated_phrases)
+                    tp_table.append(tp_batch)
+                    if text_index is not None:
+                        text_index.add_training_phrases(tp_batch)
+                    intent_ids, intent_display_names, phrases, annotated_phrases = [], [], [], []
             current_tp_index = row['training_phrase_idx']
             current_intent_id = row['name']
             current_intent_display_name = row['display_name']
@@ -406,53 +463,67 @@ def load_agent_data(agent_id, agent_name):
                 entity_type) + ' ' + str(row['parameter_id']) + '} '
         else:
             current_annotated_phrase += str(row['text']) + ' '
-    tp_count = len(phrases)
-    tp_df = pd.DataFrame({
-        'date': [curr_date for _ in range(tp_count)],
-        'agentId': [agent_id for _ in range(tp_count)],
-        'agentName': [agent_name for _ in range(tp_count)],
-        'intentId': intent_ids,
-        'intentName': intent_display_names,
-        'phrase': phrases,
-        'annotatedPhrase': annotated_phrases
-    })
-    tp_df['date'] = pd.to_datetime(tp_df['date'])
+    # The phrase parts outnumber the phrases; don't hold them past the loop
+    del intents_df
+    # The loop only emits a phrase when the next one starts, so emit the last one here
+    if current_tp_index != -1:
+        intent_ids.append(current_intent_id)
+        intent_display_names.append(current_intent_display_name)
+        phrases.append(current_phrase.strip())
+        annotated_phrases.append(current_annotated_phrase.strip())
+    tp_batch = training_phrase_batch(
+        agent_id, agent_name, intent_ids, intent_display_names, phrases, annotated_phrases)
+    tp_table.append(tp_batch)
+    if text_index is not None:
+        text_index.add_training_phrases(tp_batch)
+    tp_df = tp_table.finalize()
     print('Training phrases:', tp_df.shape)
-
-    entity_df = pd.concat([pd.DataFrame({
-        'date': [curr_date],
-        'agentId': [agent_id],
-        'agentName': [agent_name],
-        'entityTypeId': [data.name],
-        'entityTypeName': [data.display_name],
-        'entity': [entity.value],
-        'synonym': [synonym],
-    }) for data in entity_data for entity in data.entities for synonym in entity.synonyms])
-    entity_df['date'] = pd.to_datetime(entity_df['date'])
+    monitor.checkpoint('training_phrases')
+
+    entity_table = SpillableTable('Entities', monitor, preparer('Entities'))
+    for data in entity_data:
+        synonyms = [(entity.value, synonym)
+                    for entity in data.entities for synonym in entity.synonyms]
+        entity_table.append(raw_frame('Entities', {
+            'date': [curr_date for _ in synonyms],
+            'agentId': [agent_id for _ in synonyms],
+            'agentName': [agent_name for _ in synonyms],
+            'entityTypeId': [data.name for _ in synonyms],
+            'entityTypeName': [data.display_name for _ in synonyms],
+            'entity': [value for value, _ in synonyms],
+            'synonym': [synonym for _, synonym in synonyms],
+        }))
+    entity_df = entity_table.finalize()
     print('Entities:', entity_df.shape)
-
-    webhook_df = pd.concat([pd.DataFrame({
-        'date': [curr_date],
-        'agentId': [agent_id],
-        'agentName': [agent_name],
-        'webhookId': [data.name],
-        'webhookName': [data.display_name],
-        'timeout': [str(data.timeout)],
-        'serviceDirectory': [data.service_directory.service if getattr(data, 'service_directory', None) else None],
-        'url': [data.service_directory.generic_web_service.uri if getattr(data, 'service_directory', None) else data.generic_web_service.uri]
-    }) for data in webhook_data])
-    webhook_df['date'] = pd.to_datetime(webhook_df['date'])
+    monitor.checkpoint('entities')
+
+    webhook_df = build_frame('Webhooks', [{
+        'date': curr_date,
+        'agentId': agent_id,
+        'agentName': agent_name,
+        'webhookId': data.name,
+        'webhookName': data.display_name,
+        'timeout': str(data.timeout),
+        'serviceDirectory': data.service_directory.service if getattr(data, 'service_directory', None) else None,
+        'url': data.service_directory.generic_web_service.uri if getattr(data, 'service_directory', None) else data.generic_web_service.uri
+    } for data in webhook_data])
     print('Webhooks:', webhook_df.shape)
+    monitor.checkpoint('webhooks')
 
     flow_df_list = []
     page_df_list = []
     parameter_df_list = []
-    transition_df_list = []
+    transition_routes = SpillableTable(
+        'TransitionRoutes', monitor, preparer('TransitionRoutes'))
     route_group_df_list = []
+    agent_graph = AgentGraph()
+    route_collectors = [agent_graph, ref_index]
+    if text_index is not None:
+        route_collectors.append(text_index)
     for flow_id in flows_map:
         # Flows
         page_ids = [flow_id] + list(pages_map[flow_id].keys())
-        flow_df = pd.DataFrame({
+        flow_df = raw_frame('Flows', {
             'date': [curr_date],
             'agentId': [agent_id],
             'agentName': [agent_name],
@@ -461,6 +532,7 @@ def load_agent_data(agent_id, agent_name):
             'pages': [page_ids]
         })
         flow_df_list.append(flow_df)
+        agent_graph.add_flow(flow_id, flows_map[flow_id])
 
         # Pages
         # Start page is an exception as always
@@ -470,12 +542,13 @@ def load_agent_data(agent_id, agent_name):
                               pages_map, route_groups_map, webhooks_map, intents_map, page_id=flow_id)
         event_handlers = parse_routes(data.event_handlers, agent_id, agent_name, flow_id,
                                       flows_map, pages_map, route_groups_map, webhooks_map, intents_map, page_id=flow_id)
-        transition_df_list.append(routes)
-        transition_df_list.append(event_handlers)
+        collect_routes(routes, transition_routes, route_collectors)
+        collect_routes(event_handlers, transition_routes, route_collectors)
         route_ids = list(routes['transitionRouteId']) + \
             list(event_handlers['transitionRouteId'])
         route_groups = list(data.transition_route_groups)  # IDs
-        new_page = pd.DataFrame({
+        agent_graph.add_route_group_usage(flow_id, route_groups)
+        new_page = raw_frame('Pages', {
             'date': [curr_date],
             'agentId': [agent_id],
             'agentName': [agent_name],
@@ -493,6 +566,9 @@ def load_agent_data(agent_id, agent_name):
             'routes': [route_ids],
             'routeGroups': [route_groups]})
         page_df_list.append(new_page)
+        ref_index.add_pages(new_page)
+        if text_index is not None:
+            text_index.add_pages(new_page)
         # Pages other than the start page
         for page_id in pages_map[flow_id]:
             if 'START_PAGE' in page_id or 'END_SESSION' in page_id or 'END_FLOW' in page_id:
@@ -503,18 +579,25 @@ def load_agent_data(agent_id, agent_name):
             parameters, parameter_routes = parse_parameters(
                 data.form, agent_id, agent_name, flow_id, page_id, flows_map, pages_map, route_groups_map, webhooks_map, intents_map, entities_map)
             parameter_df_list.append(parameters)
+            ref_index.add_parameters(parameters)
+            if text_index is not None:
+                text_index.add_parameters(parameters)
             parameter_ids = list(parameters['parameterId'])
             routes = parse_routes(data.transition_routes, agent_id, agent_name, flow_id, flows_map,
                                   pages_map, route_groups_map, webhooks_map, intents_map, page_id=page_id)
             event_handlers = parse_routes(data.event_handlers, agent_id, agent_name, flow_id,
                                           flows_map, pages_map, route_groups_map, webhooks_map, intents_map, page_id=page_id)
-            transition_df_list.append(routes)
-            transition_df_list.append(event_handlers)
-            transition_df_list.append(parameter_routes)
+            collect_routes(routes, transition_routes, route_collectors)
+            collect_routes(event_handlers, transition_routes,
+                           route_collectors)
+            collect_routes(parameter_routes, transition_routes,
+                           route_collectors)
+            agent_graph.add_page(page_id, flow_id, data.display_name)
             route_ids = list(routes['transitionRouteId']) + list(
                 event_handlers['transitionRouteId']) + list(parameter_routes['transitionRouteId'])
             route_groups = list(data.transition_route_groups)  # IDs
-            new_page = pd.DataFrame({
+            agent_graph.add_route_group_usage(page_id, route_groups)
+            new_page = raw_frame('Pages', {
                 'date': [curr_date],
                 'agentId': [agent_id],
                 'agentName': [agent_name],
@@ -532,43 +615,74 @@ def load_agent_data(agent_id, agent_name):
                 'routes': [route_ids],
                 'routeGroups': [route_groups]})
             page_df_list.append(new_page)
+            ref_index.add_pages(new_page)
+            if text_index is not None:
+                text_index.add_pages(new_page)
         for route_group_id in route_group_data[flow_id]:
             route_group = route_group_data[flow_id][route_group_id]
             routes = parse_routes(route_group.transition_routes, agent_id, agent_name, flow_id, flows_map,
                                   pages_map, route_groups_map, webhooks_map, intents_map, route_group_id=route_group_id)
-            transition_df_list.append(routes)
+            collect_routes(routes, transition_routes, route_collectors)
             route_ids = list(routes['transitionRouteId'])
-            route_group_df = pd.DataFrame({
+            route_group_df = raw_frame('RouteGroups', {
                 'date': [curr_date],
                 'agentId': [agent_id],
                 'agentName': [agent_name],
                 'flowId': [flow_id],
                 'flowName': [flows_map[flow_id]],
-                'routeGroupId': [data.name],
-                'routeGroupName': [data.display_name],
+                'routeGroupId': [route_group_id],
+                'routeGroupName': [route_group.display_name],
                 'routes': [route_ids]
             })
             route_group_df_list.append(route_group_df)
 
-    flow_df = pd.concat(flow_df_list)
-    flow_df['date'] = pd.to_datetime(flow_df['date'])
+    monitor.checkpoint('flows_pages_routes')
+
+    flow_df = concat_frames('Flows', flow_df_list)
     print('Flows:', flow_df.shape)
 
-    page_df = pd.concat(page_df_list)
-    page_df['date'] = pd.to_datetime(page_df['date'])
+    page_df = concat_frames('Pages', page_df_list)
     print('Pages:', page_df.shape)
 
-    parameter_df = pd.concat(parameter_df_list)
-    parameter_df['date'] = pd.to_datetime(parameter_df['date'])
+    parameter_df = concat_frames('Parameters', parameter_df_list)
     print('Parameters:', parameter_df.shape)
 
-    transition_route_df = pd.concat(transition_df_list)
-    transition_route_df['date'] = pd.to_datetime(transition_route_df['date'])
+    transition_route_df = transition_routes.finalize()
     print('Routes:', transition_route_df.shape)
 
-    route_group_df = pd.concat(route_group_df_list)
-    route_group_df['date'] = pd.to_datetime(route_group_df['date'])
+    route_group_df = concat_frames('RouteGroups', route_group_df_list)
     print('Route Groups:', route_group_df.shape)
+    monitor.checkpoint('tables')
+
+    # Page/flow transition graph summaries
+    page_graph, flow_graph = agent_graph.to_tables(
+        curr_date, agent_id, agent_name)
+    page_graph_df = build_frame('PageGraph', page_graph)
+    print('Page Graph:', page_graph_df.shape)
+
+    flow_graph_df = build_frame('FlowGraph', flow_graph)
+    print('Flow Graph:', flow_graph_df.shape)
+    monitor.checkpoint('graph')
+
+    # Reverse references (where is each intent/webhook/entity type/route group used)
+    referenced_names = {**intents_map, **webhooks_map, **entities_map}
+    for fid in route_groups_map:
+        referenced_names.update(route_groups_map[fid])
+    reference_df = build_frame('References', ref_index.to_table(
+        curr_date, agent_id, agent_name, referenced_names))
+    print('References:', reference_df.shape)
+    monitor.checkpoint('references')
+
+    if text_index is not None:
+        text_terms_df = build_frame('TextTerms', text_index.to_table(
+            curr_date, agent_id, agent_name))
+        print('Text index terms:', text_terms_df.shape)
+        monitor.checkpoint('text_index')
+
+    run_report_df = monitor.report()
+    monitor.stop()
+    print('Run report:')
+    print(run_report_df.to_string(index=False))
 
     # Create overall structure junction table
     """
@@ -589,7 +703,7 @@ def load_agent_data(agent_id, agent_name):
     print('Structure:', structure_df.shape)
     """
 
-    return {
+    agent_data = {
         'Intents': intent_df,
         'TrainingPhrases': tp_df,
         'Entities': entity_df,
@@ -599,263 +713,78 @@ def load_agent_data(agent_id, agent_name):
         'TransitionRoutes': transition_route_df,
         'RouteGroups': route_group_df,
         'Parameters': parameter_df,
+        'PageGraph': page_graph_df,
+        'FlowGraph': flow_graph_df,
+        'References': reference_df,
+        'ReferenceIndex': ref_index,
+        'RunReport': run_report_df,
         # 'Structure': structure_df
     }
+    if text_index is not None:
+        agent_data['TextTerms'] = text_terms_df
+        agent_data['TextIndex'] = text_index
+    return agent_data
 
 
 def write_to_bq(agent_data, project_id):
-    # Pages
-    pages_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "fulfillment",
-            "type": "STRING",
-            "mode": "REPEATED"
-        },
-        {
-            "name": "partialResponse",
-            "type": "BOOLEAN",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "parameterPresets",
-            "type": "STRING",
-            "mode": "REPEATED"
-        },
-        {
-            "name": "parameters",
-            "type": "STRING",
-            "mode": "REPEATED"
-        },
-        {
-            "name": "routes",
-            "type": "STRING",
-            "mode": "REPEATED"
-        },
-        {
-            "name": "routeGroups",
-            "type": "STRING",
-            "mode": "REPEATED"
-        }
-    ]
-
-    pages_table_id = 'agent_structure.pages'
-    print(
-        f"Writing data to Bigquery table {pages_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['Pages'], pages_table_id, project_id=project_id,
-                      if_exists='append', table_schema=pages_schema, progress_bar=False)
-    print(
-        f"Done writing to Bigquery table {pages_table_id} in project {project_id}")
-
-    # Flows
-    flows_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "pages",
-            "type": "STRING",
-            "mode": "REPEATED"
-        }
-    ]
-
-    flows_table_id = 'agent_structure.flows'
-    print(
-        f"Writing data to Bigquery table {flows_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['Flows'], flows_table_id, project_id=project_id,
-                      if_exists='append', table_schema=flows_schema, progress_bar=False)
+    # Every table the snapshot has (the text index is optional), with the
+    # full schema from the registry; the run report is only kept locally
+    for key, table_name in TABLE_NAMES.items():
+        if key not in agent_data or key == 'RunReport':
+            continue
+        table_id = f"agent_structure.{table_name}"
+        print(
+            f"Writing data to Bigquery table {table_id} in project {project_id}")
+        for chunk in iter_frames(agent_data[key]):
+            pandas_gbq.to_gbq(chunk, table_id, project_id=project_id,
+                              if_exists='append', table_schema=bq_schema(key), progress_bar=False)
+        print(
+            f"Done writing to Bigquery table {table_id} in project {project_id}")
+
+
+def write_content_addressed(agent_data, project_id, agent_id, agent_name):
+    objects, membership = split_snapshot(
+        agent_data, curr_date, agent_id, agent_name)
+    objects_df = build_frame('Objects', objects)
+    content_store = get_content_store(project_id)
+    existing = content_store.existing(list(objects_df['contentHash']))
+    objects_df = objects_df[~objects_df['contentHash'].isin(existing)]
+    membership_df = build_frame('ObjectMembership', membership)
     print(
-        f"Done writing to Bigquery table {flows_table_id} in project {project_id}")
-
-    # Intents
-    intents_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "parameters",
-            "type": "STRING",
-            "mode": "REPEATED"
-        },
-        {
-            "name": "labels",
-            "type": "STRING",
-            "mode": "REPEATED"
-        }
-    ]
-
-    intents_table_id = 'agent_structure.intents'
-    print(
-        f"Writing data to Bigquery table {intents_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['Intents'], intents_table_id, project_id=project_id,
-                      if_exists='append', table_schema=intents_schema, progress_bar=False)
-    print(
-        f"Done writing to Bigquery table {intents_table_id} in project {project_id}")
-
-    # Training Phrases
-    tp_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        }
-    ]
-
-    tp_table_id = 'agent_structure.training_phrases'
-    print(
-        f"Writing data to Bigquery table {tp_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['TrainingPhrases'], tp_table_id, project_id=project_id,
-                      if_exists='append', table_schema=tp_schema, progress_bar=False)
-    print(
-        f"Done writing to Bigquery table {tp_table_id} in project {project_id}")
-
-    # Entities
-    entities_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        }
-    ]
-
-    entities_table_id = 'agent_structure.entity_types'
-    print(
-        f"Writing data to Bigquery table {entities_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['Entities'], entities_table_id, project_id=project_id,
-                      if_exists='append', table_schema=entities_schema, progress_bar=False)
-    print(
-        f"Done writing to Bigquery table {entities_table_id} in project {project_id}")
-
-    # Webhooks
-    webhooks_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        }
-    ]
-
-    webhooks_table_id = 'agent_structure.webhooks'
-    print(
-        f"Writing data to Bigquery table {webhooks_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['Webhooks'], webhooks_table_id, project_id=project_id,
-                      if_exists='append', table_schema=webhooks_schema, progress_bar=False)
-    print(
-        f"Done writing to Bigquery table {webhooks_table_id} in project {project_id}")
-
-    # Route Groups
-    route_groups_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "routes",
-            "type": "STRING",
-            "mode": "REPEATED"
-        }
-    ]
-
-    route_groups_table_id = 'agent_structure.transition_route_groups'
-    print(
-        f"Writing data to Bigquery table {route_groups_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['RouteGroups'], route_groups_table_id, project_id=project_id,
-                      if_exists='append', table_schema=route_groups_schema, progress_bar=False)
-    print(
-        f"Done writing to Bigquery table {route_groups_table_id} in project {project_id}")
-
-    # Parameters
-    parameters_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "required",
-            "type": "BOOLEAN",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "isList",
-            "type": "BOOLEAN",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "redactInLog",
-            "type": "BOOLEAN",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "fulfillment",
-            "type": "STRING",
-            "mode": "REPEATED"
-        },
-        {
-            "name": "partialResponse",
-            "type": "BOOLEAN",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "parameterPresets",
-            "type": "STRING",
-            "mode": "REPEATED"
-        },
-        {
-            "name": "routes",
-            "type": "STRING",
-            "mode": "REPEATED"
-        }
-    ]
-
-    parameters_table_id = 'agent_structure.parameters'
-    print(
-        f"Writing data to Bigquery table {parameters_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['Parameters'], parameters_table_id, project_id=project_id,
-                      if_exists='append', table_schema=parameters_schema, progress_bar=False)
-    print(
-        f"Done writing to Bigquery table {parameters_table_id} in project {project_id}")
-
-    # Transition Routes
-    transition_routes_schema = [
-        {
-            "name": "date",
-            "type": "DATETIME",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "fulfillment",
-            "type": "STRING",
-            "mode": "REPEATED"
-        },
-        {
-            "name": "partialResponse",
-            "type": "BOOLEAN",
-            "mode": "NULLABLE"
-        },
-        {
-            "name": "parameterPresets",
-            "type": "STRING",
-            "mode": "REPEATED"
-        }
-    ]
-
-    transition_routes_table_id = 'agent_structure.transition_routes'
+        f"Content-addressed objects: {len(objects_df)} new of {len(objects['contentHash'])} distinct, {len(membership_df)} memberships")
+
+    if len(objects_df):
+        print(
+            f"Writing data to Bigquery table {OBJECTS_TABLE_ID} in project {project_id}")
+        content_store.write(objects_df)
+        print(
+            f"Done writing to Bigquery table {OBJECTS_TABLE_ID} in project {project_id}")
+
     print(
-        f"Writing data to Bigquery table {transition_routes_table_id} in project {project_id}")
-    pandas_gbq.to_gbq(agent_data['TransitionRoutes'], transition_routes_table_id, project_id=project_id,
-                      if_exists='append', table_schema=transition_routes_schema, progress_bar=False)
+        f"Writing data to Bigquery table {MEMBERSHIP_TABLE_ID} in project {project_id}")
+    pandas_gbq.to_gbq(membership_df, MEMBERSHIP_TABLE_ID, project_id=project_id,
+                      if_exists='append', table_schema=bq_schema('ObjectMembership'), progress_bar=False)
     print(
-        f"Done writing to Bigquery table {transition_routes_table_id} in project {project_id}")
+        f"Done writing to Bigquery table {MEMBERSHIP_TABLE_ID} in project {project_id}")
+
+
+def write_to_local(agent_data, output_dir, agent_id):
+    """Write every table as Parquet under
+    <output_dir>/<agent path with _>/<snapshot time>/<table>/part-NNNNN.parquet.
+    Spilled tables keep one part per chunk. Returns the snapshot directory."""
+    snapshot = curr_date.strftime('%Y%m%dT%H%M%S')
+    snapshot_dir = os.path.join(output_dir, agent_id.replace('/', '_'), snapshot)
+    print(f"Writing data to local directory {snapshot_dir}")
+    for key, table_name in TABLE_NAMES.items():
+        if key not in agent_data:
+            continue
+        table_dir = os.path.join(snapshot_dir, table_name)
+        os.makedirs(table_dir, exist_ok=True)
+        for i, chunk in enumerate(iter_frames(agent_data[key])):
+            chunk.to_parquet(os.path.join(table_dir, f"part-{i:05d}.parquet"),
+                             index=False, schema=parquet_schema(key))
+    print(f"Done writing to local directory {snapshot_dir}")
+    return snapshot_dir
 
 
 def main(event, context=None):
@@ -866,25 +795,60 @@ def main(event, context=None):
         message_data = json.loads(data)
 
         # Extract agent data from message_data
-        for agent in message_data:
+        for agent in dedupe_agents(message_data):
             agent_project_id = agent["agent_project_id"]
             agent_location = agent["agent_location"]
             agent_id = agent["agent_id"]
             bq_project_id = agent["bq_project_id"]
             full_agent_path = f"projects/{agent_project_id}/locations/{agent_location}/agents/{agent_id}"
 
-            # Get agent name
-            dfcx_a = Agents()
-            agent_name = dfcx_a.get_agent(
-                agent_id=full_agent_path).display_name
-
-            # Get agent data and parse
-            print("Loading agent: ", agent_name)
-            agent_data = load_agent_data(
-                full_agent_path, agent_name)
+            # Skip agents captured (or being captured) within the coalescing window
+            # The store kind is deployment configuration, never message data
+            state_store = get_state_store(DEFAULT_STATE_STORE, bq_project_id)
+            state_key = agent_key(agent)
+            window = float(agent.get(
+                "coalesce_window_seconds", DEFAULT_WINDOW_SECONDS))
+            if not state_store.acquire(state_key, window):
+                print(f"Skipping {full_agent_path}: captured within the last {window:.0f}s")
+                continue
 
-            # Write agent information to BQ
-            write_to_bq(agent_data, bq_project_id)
+            agent_data = None
+            try:
+                # Get agent name
+                dfcx_a = throttled(Agents(), full_agent_path)
+                agent_obj = dfcx_a.get_agent(agent_id=full_agent_path)
+                agent_name = agent_obj.display_name
+
+                # Optionally skip the full extraction if nothing has changed
+                fingerprint = None
+                resources = None
+                if agent.get("precheck", DEFAULT_PRECHECK):
+                    resources = fetch_agent_resources(full_agent_path)
+                    fingerprint = agent_fingerprint(agent_obj, **resources)
+                    if fingerprint == state_store.fingerprint(state_key):
+                        print(f"Skipping {agent_name}: unchanged since last capture")
+                        state_store.abandon(state_key)
+                        continue
+
+                # Get agent data and parse
+                print("Loading agent: ", agent_name)
+                agent_data = load_agent_data(
+                    full_agent_path, agent_name, resources=resources)
+
+                # Write agent information to BQ
+                storage_mode = agent.get("storage_mode", DEFAULT_STORAGE_MODE)
+                if storage_mode == 'content_addressed':
+                    write_content_addressed(
+                        agent_data, bq_project_id, full_agent_path, agent_name)
+                else:
+                    write_to_bq(agent_data, bq_project_id)
+            except Exception:
+                state_store.abandon(state_key)
+                raise
+            finally:
+                if agent_data is not None:
+                    cleanup_spilled(agent_data)
+            state_store.release(state_key, fingerprint)
 
     except Exception as e:
         print(f"Error: {e}")
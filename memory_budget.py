@@ -0,0 +1,221 @@
+"""
+Memory budget tracking and spill-to-disk for load_agent_data
+
+MemoryMonitor samples RSS (and tracemalloc, when a budget is set or
+MEMORY_TRACE=1) at stage boundaries and keeps each stage's peak for the run
+report. SpillableTable collects row batches for the big tables and writes them
+to temporary Parquet files once the process gets close to its budget; the
+batches are streamed back chunk by chunk at write time. The budget is checked
+whenever a table has buffered CHECK_ROWS rows or CHECK_BYTES bytes since its
+last check, at every stage boundary and when a table is finalized.
+"""
+
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from table_schemas import build_frame, columns, raw_frame
+
+DEFAULT_BUDGET_MB = float(os.environ['MEMORY_BUDGET_MB']) if os.environ.get(
+    'MEMORY_BUDGET_MB') else None
+# Spill once RSS passes this fraction of the budget
+SPILL_FRACTION = float(os.environ.get('MEMORY_SPILL_FRACTION', 0.8))
+MB = 1024 * 1024
+# Check the budget once a table has buffered this many rows or bytes since
+# its last check (batches range from one route to a whole intent's phrases)
+CHECK_ROWS = int(os.environ.get('MEMORY_CHECK_ROWS', 20000))
+CHECK_BYTES = int(float(os.environ.get('MEMORY_CHECK_MB', 16)) * MB)
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / MB
+    except OSError:
+        # No procfs (e.g. macOS): fall back to the peak RSS, reported in
+        # bytes there
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / MB
+
+
+def trace_enabled(budget_mb):
+    """Whether tracemalloc is wanted by default for this budget"""
+    return budget_mb is not None or os.environ.get('MEMORY_TRACE', '') == '1'
+
+
+class MemoryMonitor:
+    """trace=False leaves tracemalloc alone, e.g. when several agents share
+    the process and the caller traces the whole run"""
+
+    def __init__(self, budget_mb=DEFAULT_BUDGET_MB, trace=None):
+        self.budget_mb = budget_mb
+        if trace is None:
+            trace = trace_enabled(budget_mb)
+        self.trace = trace
+        self.started_tracing = False
+        if trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        self.stages = []
+        self.stage_started = time.monotonic()
+        self.stage_peak_rss = current_rss_mb()
+        self.spilled_batches = 0
+        self.tables = []  # Unfinalized SpillableTables, spilled at checkpoints
+
+    def sample(self):
+        rss = current_rss_mb()
+        self.stage_peak_rss = max(self.stage_peak_rss, rss)
+        return rss
+
+    def near_budget(self):
+        return (self.budget_mb is not None
+                and self.sample() >= self.budget_mb * SPILL_FRACTION)
+
+    def checkpoint(self, stage):
+        """Close the current stage and record its peak usage, spilling the
+        open tables if the budget is near"""
+        rss = self.sample()
+        for table in self.tables:
+            table.maybe_spill()
+        peak_traced = None
+        if self.trace:
+            peak_traced = tracemalloc.get_traced_memory()[1] / MB
+            tracemalloc.reset_peak()
+        now = time.monotonic()
+        self.stages.append({
+            'stage': stage,
+            'seconds': round(now - self.stage_started, 3),
+            'peakTracedMb': (None if peak_traced is None
+                             else round(peak_traced, 1)),
+            'peakRssMb': round(self.stage_peak_rss, 1),
+            'endRssMb': round(rss, 1),
+            'spilledBatches': self.spilled_batches,
+        })
+        self.stage_started = now
+        self.stage_peak_rss = rss
+
+    def report(self):
+        return build_frame('RunReport', self.stages)
+
+    def stop(self):
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+
+def restore_lists(df):
+    """Parquet hands list columns back as numpy arrays; the rest of the
+    pipeline (and pandas_gbq REPEATED fields) expects lists"""
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = [
+                value.tolist() if isinstance(value, np.ndarray) else value
+                for value in df[column]]
+    return df
+
+
+class SpillableTable:
+    """Row batches for one table, kept in memory until the monitor reports the
+    budget is near, then written to Parquet in spill_dir"""
+
+    def __init__(self, name, monitor, prepare=None):
+        self.name = name
+        self.monitor = monitor
+        self.prepare = prepare  # Applied to each concatenated chunk
+        self.batches = []
+        self.files = []
+        self.rows = 0
+        self.spill_dir = None
+        self.unchecked_rows = 0
+        self.unchecked_bytes = 0
+        monitor.tables.append(self)
+
+    def append(self, df):
+        self.batches.append(df)
+        self.rows += len(df)
+        self.unchecked_rows += len(df)
+        # Shallow size: cheap, and enough to notice wide or huge batches
+        self.unchecked_bytes += int(df.memory_usage(index=False).sum())
+        if (self.unchecked_rows >= CHECK_ROWS
+                or self.unchecked_bytes >= CHECK_BYTES):
+            self.maybe_spill()
+
+    def maybe_spill(self):
+        self.unchecked_rows = self.unchecked_bytes = 0
+        if self.batches and self.monitor.near_budget():
+            self.spill()
+
+    def _chunk(self, batches):
+        # name is the table's registry key, so a table that never got a
+        # batch still has its columns
+        chunk = pd.concat(batches) if batches else raw_frame(self.name)
+        if self.prepare is not None:
+            chunk = self.prepare(chunk)
+        return chunk
+
+    def spill(self):
+        if not any(len(batch) for batch in self.batches):
+            # Only empty header batches so far, nothing worth a file
+            self.batches = []
+            return
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(
+                prefix=f"agent_structure_{self.name}_")
+        path = os.path.join(self.spill_dir, f"{len(self.files):05d}.parquet")
+        self._chunk(self.batches).to_parquet(path, index=False)
+        rows = sum(len(batch) for batch in self.batches)
+        print(f"Spilled {rows} {self.name} rows to {path}")
+        self.files.append(path)
+        self.batches = []
+        self.monitor.spilled_batches += 1
+
+    @property
+    def spilled(self):
+        return bool(self.files)
+
+    @property
+    def shape(self):
+        return (self.rows, len(columns(self.name)))
+
+    def frames(self):
+        """Yield the table chunk by chunk: spilled files, then what is still
+        in memory"""
+        for path in self.files:
+            yield restore_lists(pd.read_parquet(path))
+        if self.batches:
+            yield self._chunk(self.batches)
+
+    def finalize(self):
+        """Return a plain DataFrame if nothing was spilled, else self"""
+        self.maybe_spill()
+        if self.spilled:
+            return self
+        # The batches now live on in the returned frame
+        self.monitor.tables.remove(self)
+        return self._chunk(self.batches)
+
+    def cleanup(self):
+        if self.spill_dir is not None:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            self.spill_dir = None
+            self.files = []
+
+
+def iter_frames(table):
+    """Chunks of a table that may be a DataFrame or a spilled SpillableTable"""
+    if isinstance(table, SpillableTable):
+        yield from table.frames()
+    else:
+        yield table
+
+
+def cleanup_spilled(agent_data):
+    """Remove the temporary files of any spilled tables in agent_data"""
+    for table in agent_data.values():
+        if isinstance(table, SpillableTable):
+            table.cleanup()
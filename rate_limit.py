@@ -0,0 +1,275 @@
+"""
+Quota-aware throttling for DFCX reads
+
+All scrapi clients for an agent share one token bucket per project and region,
+so parallel extractions stay under the per-project read quota. Calls that fail
+with RESOURCE_EXHAUSTED/UNAVAILABLE are retried with jittered exponential
+backoff, and the bucket rate is cut on each quota error and recovers slowly on
+success (AIMD), so throughput settles just under the quota.
+
+Tokens are charged per RPC, not per scrapi method: list_pages, get_*_map and
+bulk_intent_to_df page through several RPCs inside one call. Each throttled
+call takes one token up front, and a hook on the DFCX services' transports
+takes one more for every further RPC (e.g. next-page requests) the call makes
+on the same thread. Only the DFCX transports are hooked, so other GAPIC
+clients in the process (BigQuery etc.) are untouched.
+
+The hook relies on the generated transports' _prep_wrapped_messages and
+_wrapped_methods, which are private to google-cloud-dialogflow-cx (pinned in
+requirements.txt). If an upgrade drops them, RPC_HOOK_INSTALLED is False, a
+warning is printed, the limiter falls back to one token per scrapi call and
+test_rate_limit.py fails.
+"""
+
+import importlib
+import os
+import random
+import threading
+import time
+
+from google.api_core import exceptions as core_exceptions
+
+# DFCX's default "read requests per minute" quota is per project and region
+DEFAULT_READS_PER_MINUTE = float(os.environ.get('DFCX_READS_PER_MINUTE', 600))
+DEFAULT_MAX_RETRIES = int(os.environ.get('DFCX_MAX_RETRIES', 6))
+
+RETRYABLE_ERRORS = (
+    core_exceptions.ResourceExhausted,  # RESOURCE_EXHAUSTED / HTTP 429
+    core_exceptions.ServiceUnavailable,  # UNAVAILABLE / HTTP 503
+)
+
+
+# Transport base class of every DFCX service scrapi reads through
+DFCX_TRANSPORTS = {
+    'agents': 'AgentsTransport',
+    'entity_types': 'EntityTypesTransport',
+    'flows': 'FlowsTransport',
+    'intents': 'IntentsTransport',
+    'pages': 'PagesTransport',
+    'transition_route_groups': 'TransitionRouteGroupsTransport',
+    'webhooks': 'WebhooksTransport',
+}
+
+# The limiter of the throttled call running on this thread, if any
+_active = threading.local()
+
+
+def count_rpcs(rpc):
+    """Wrap a transport's wrapped method so each RPC after the first one of a
+    throttled call takes its own token"""
+    def counted(*args, **kwargs):
+        limiter = getattr(_active, 'limiter', None)
+        if limiter is not None:
+            limiter.rpc()
+        return rpc(*args, **kwargs)
+    return counted
+
+
+def hook_transport(transport_class):
+    """Count the RPCs of every transport of transport_class (and its grpc and
+    rest subclasses) created from now on"""
+    prep = transport_class._prep_wrapped_messages
+    if getattr(prep, 'counts_rpcs', False):
+        return
+
+    def prep_counted(self, client_info):
+        prep(self, client_info)
+        self._wrapped_methods = {method: count_rpcs(rpc) for method, rpc
+                                 in self._wrapped_methods.items()}
+    prep_counted.counts_rpcs = True
+    transport_class._prep_wrapped_messages = prep_counted
+
+
+def install_rpc_hook():
+    """Hook the DFCX transports once. Returns False if any of them has no
+    wrapped methods to hook."""
+    installed = True
+    for service, class_name in DFCX_TRANSPORTS.items():
+        try:
+            module = importlib.import_module(
+                'google.cloud.dialogflowcx_v3beta1.services.'
+                f'{service}.transports.base')
+        except ImportError:
+            module = None
+        transport_class = getattr(module, class_name, None)
+        if not hasattr(transport_class, '_prep_wrapped_messages'):
+            print(f"Warning: cannot count RPCs of {class_name}; "
+                  "its calls take one token each")
+            installed = False
+            continue
+        hook_transport(transport_class)
+    return installed
+
+
+RPC_HOOK_INSTALLED = install_rpc_hook()
+
+
+def parse_agent_path(agent_path):
+    """Return (project, region) from any projects/*/locations/*/... path"""
+    parts = agent_path.split('/')
+    if len(parts) < 4 or parts[0] != 'projects' or parts[2] != 'locations':
+        raise ValueError(f"Not a DFCX resource path: {agent_path}")
+    return parts[1], parts[3]
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate  # tokens per second
+        self.max_rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Take one token, sleeping until one is available. Returns the time
+        spent waiting in seconds."""
+        with self.lock:
+            self._refill()
+            # Reserve the token up front; a negative balance is the queue of
+            # callers already waiting for a refill
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            self.sleep(wait)
+        return wait
+
+    def decrease(self, factor=0.5, min_rate=0.1):
+        with self.lock:
+            self._refill()
+            self.rate = max(min_rate, self.rate * factor)
+
+    def increase(self, step=None):
+        with self.lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate +
+                            (step if step is not None else self.max_rate / 20))
+
+
+class RateLimiter:
+    def __init__(self, reads_per_minute=DEFAULT_READS_PER_MINUTE,
+                 max_retries=DEFAULT_MAX_RETRIES, base_delay=1.0,
+                 max_delay=60.0, clock=time.monotonic, sleep=time.sleep,
+                 rand=random.random):
+        self.bucket = TokenBucket(
+            reads_per_minute / 60, clock=clock, sleep=sleep)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.rand = rand
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'rpcs': 0,
+            'throttle_waits': 0,
+            'throttle_wait_seconds': 0.0,
+            'retries': 0,
+            'retry_wait_seconds': 0.0,
+            'failures': 0,
+        }
+
+    def _count(self, key, amount=1):
+        with self.stats_lock:
+            self.stats[key] += amount
+
+    def rpc(self):
+        """Called by the GAPIC hook for every RPC of the current call. The
+        first RPC is covered by the token the call took."""
+        self._count('rpcs')
+        _active.rpcs += 1
+        if _active.rpcs > 1:
+            waited = self.bucket.acquire()
+            if waited:
+                self._count('throttle_waits')
+                self._count('throttle_wait_seconds', waited)
+
+    def backoff(self, attempt):
+        """Full jitter: uniform between 0 and the capped exponential delay"""
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return self.rand() * cap
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            self._count('calls')
+            if waited:
+                self._count('throttle_waits')
+                self._count('throttle_wait_seconds', waited)
+            _active.limiter, _active.rpcs = self, 0
+            try:
+                result = func(*args, **kwargs)
+            except RETRYABLE_ERRORS as e:
+                if isinstance(e, core_exceptions.ResourceExhausted):
+                    self.bucket.decrease()
+                if attempt >= self.max_retries:
+                    self._count('failures')
+                    raise
+                delay = self.backoff(attempt)
+                attempt += 1
+                self._count('retries')
+                self._count('retry_wait_seconds', delay)
+                method_name = getattr(func, '__name__', 'call')
+                print(f"{type(e).__name__} on {method_name}, retry "
+                      f"{attempt}/{self.max_retries} in {delay:.1f}s")
+                self.sleep(delay)
+                continue
+            finally:
+                _active.limiter = None
+            self.bucket.increase()
+            return result
+
+
+class ThrottledClient:
+    """Proxy that routes every public method of a scrapi client through a
+    RateLimiter"""
+
+    def __init__(self, client, limiter):
+        self._client = client
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return self._limiter.call(attr, *args, **kwargs)
+        call.__name__ = name
+        return call
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(project, region):
+    """Shared limiter for a project and region"""
+    with _limiters_lock:
+        if (project, region) not in _limiters:
+            _limiters[(project, region)] = RateLimiter()
+        return _limiters[(project, region)]
+
+
+def throttled(client, resource_path):
+    """Wrap a scrapi client with the limiter for resource_path's
+    project/region"""
+    limiter = get_limiter(*parse_agent_path(resource_path))
+    return ThrottledClient(client, limiter)
+
+
+def limiter_stats():
+    """Counters for every limiter, keyed by 'project/region'"""
+    with _limiters_lock:
+        return {f"{project}/{region}": dict(limiter.stats)
+                for (project, region), limiter in _limiters.items()}
@@ -0,0 +1,115 @@
+"""
+Reverse-reference index for a DFCX agent
+
+Maps each referenced intent, webhook, entity type and route group to the
+routes, pages, parameters and intents that reference it. Filled while
+load_agent_data builds the flat tables and emitted as the References table.
+"""
+
+from collections import defaultdict
+
+from table_schemas import present, route_parent
+
+INTENT = 'intent'
+WEBHOOK = 'webhook'
+ENTITY_TYPE = 'entityType'
+ROUTE_GROUP = 'routeGroup'
+
+ROUTE = 'route'
+PAGE = 'page'
+PARAMETER = 'parameter'
+
+
+class ReferenceIndex:
+    def __init__(self):
+        # (referenced type, referenced ID) -> {referrer key: count}
+        # where referrer key = (referrer type, referrer ID, parent ID, flow ID)
+        self.references = defaultdict(lambda: defaultdict(int))
+
+    def add(self, referenced_type, referenced_id, referrer_type, referrer_id,
+            parent_id=None, flow_id=None):
+        if not present(referenced_id):
+            return
+        key = (referrer_type, referrer_id, parent_id, flow_id)
+        self.references[(referenced_type, referenced_id)][key] += 1
+
+    def add_routes(self, routes):
+        """Record the intents and webhooks used by a parse_routes DataFrame"""
+        columns = ['flowId', 'pageId', 'routeGroupId', 'parameterId',
+                   'transitionRouteId', 'intentId', 'webhookId']
+        for row in routes[columns].itertuples(index=False):
+            # Route IDs are only unique within the page/parameter/route group
+            parent_id = route_parent(row)
+            self.add(INTENT, row.intentId, ROUTE,
+                     row.transitionRouteId, parent_id, row.flowId)
+            self.add(WEBHOOK, row.webhookId, ROUTE,
+                     row.transitionRouteId, parent_id, row.flowId)
+
+    def add_pages(self, pages):
+        """Record the webhooks and route groups used by page rows"""
+        columns = ['flowId', 'pageId', 'webhookId', 'routeGroups']
+        for row in pages[columns].itertuples(index=False):
+            self.add(WEBHOOK, row.webhookId, PAGE,
+                     row.pageId, flow_id=row.flowId)
+            for route_group_id in row.routeGroups:
+                self.add(ROUTE_GROUP, route_group_id, PAGE,
+                         row.pageId, flow_id=row.flowId)
+
+    def add_parameters(self, parameters):
+        """Record the entity types and webhooks used by form parameters"""
+        columns = ['flowId', 'pageId', 'parameterId', 'entityId',
+                   'webhookId']
+        for row in parameters[columns].itertuples(index=False):
+            self.add(ENTITY_TYPE, row.entityId, PARAMETER,
+                     row.parameterId, row.pageId, row.flowId)
+            self.add(WEBHOOK, row.webhookId, PARAMETER,
+                     row.parameterId, row.pageId, row.flowId)
+
+    def add_intent(self, intent):
+        """Record the entity types used by an intent's parameters"""
+        for param in intent.parameters:
+            self.add(ENTITY_TYPE, param.entity_type, INTENT, intent.name)
+
+    def referrers(self, referenced_type, referenced_id, referrer_type=None):
+        """Return [(referrer type, referrer ID, parent ID, flow ID, count)]"""
+        found = self.references.get((referenced_type, referenced_id), {})
+        return [key + (count,) for key, count in found.items()
+                if referrer_type is None or key[0] == referrer_type]
+
+    def count(self, referenced_type, referenced_id):
+        found = self.references.get((referenced_type, referenced_id), {})
+        return sum(found.values())
+
+    def flows(self, referenced_type, referenced_id):
+        found = self.references.get((referenced_type, referenced_id), {})
+        return {key[3] for key in found if key[3]}
+
+    def unused(self, referenced_type, referenced_ids):
+        """Return the IDs from referenced_ids nothing refers to"""
+        return [referenced_id for referenced_id in referenced_ids
+                if (referenced_type, referenced_id) not in self.references]
+
+    def to_table(self, date, agent_id, agent_name, names):
+        """Return the References table as a dict of columns. names maps
+        referenced IDs to display names."""
+        table = {column: [] for column in (
+            'date', 'agentId', 'agentName', 'referencedType', 'referencedId',
+            'referencedName', 'referrerType', 'referrerId', 'parentId',
+            'flowId', 'count')}
+        for (referenced_type, referenced_id), referrers in \
+                self.references.items():
+            for referrer, count in referrers.items():
+                referrer_type, referrer_id, parent_id, flow_id = referrer
+                table['date'].append(date)
+                table['agentId'].append(agent_id)
+                table['agentName'].append(agent_name)
+                table['referencedType'].append(referenced_type)
+                table['referencedId'].append(referenced_id)
+                table['referencedName'].append(
+                    names.get(referenced_id, referenced_id.split('/')[-1]))
+                table['referrerType'].append(referrer_type)
+                table['referrerId'].append(referrer_id)
+                table['parentId'].append(parent_id)
+                table['flowId'].append(flow_id)
+                table['count'].append(count)
+        return table
@@ -0,0 +1,227 @@
+"""
+Diff two agent structure snapshots
+
+A snapshot can be loaded live from DFCX (live:projects/.../agents/...), from a
+local sink snapshot directory written by backfill.py, or from a package (a zip
+of such a directory, see the package command). Rows are normalised like the
+content-addressed store, hash-joined on their resource keys and compared
+field by field, so a diff is linear in agent size:
+
+    python snapshot_diff.py diff out/<agent>/<old> out/<agent>/<new>
+    python snapshot_diff.py diff snapshot.zip live:<agent path>
+    python snapshot_diff.py package out/<agent>/<snapshot> snapshot.zip
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from collections import defaultdict
+
+import pandas as pd
+from tabulate import tabulate
+
+import main
+from content_store import TABLE_KEYS, normalize_row
+from memory_budget import cleanup_spilled, iter_frames, restore_lists
+from rate_limit import throttled
+
+LIVE_PREFIX = 'live:'
+TABLE_DIRS = {key: main.TABLE_NAMES[key] for key in TABLE_KEYS}
+
+
+def snapshot_dir(path):
+    """Accept a snapshot directory or an agent directory holding several
+    snapshots (the latest is used)"""
+    if any(os.path.isdir(os.path.join(path, table_dir))
+           for table_dir in TABLE_DIRS.values()):
+        return path
+    snapshots = sorted(entry for entry in os.listdir(path)
+                       if os.path.isdir(os.path.join(path, entry)))
+    if not snapshots:
+        raise ValueError(f"No agent structure snapshot in {path}")
+    return os.path.join(path, snapshots[-1])
+
+
+def read_local_snapshot(path):
+    path = snapshot_dir(path)
+    agent_data = {}
+    for key, table_dir in TABLE_DIRS.items():
+        table_path = os.path.join(path, table_dir)
+        parts = sorted(os.listdir(table_path)) if os.path.isdir(
+            table_path) else []
+        frames = [
+            restore_lists(pd.read_parquet(os.path.join(table_path, part)))
+            for part in parts if part.endswith('.parquet')]
+        agent_data[key] = pd.concat(frames) if frames else pd.DataFrame()
+    return agent_data
+
+
+def load_snapshot(source):
+    """Return (agent_data, agent_id, label) for a live agent, snapshot
+    directory or package"""
+    if source.startswith(LIVE_PREFIX):
+        agent_id = source[len(LIVE_PREFIX):]
+        agent_name = throttled(main.Agents(), agent_id).get_agent(
+            agent_id=agent_id).display_name
+        return main.load_agent_data(agent_id, agent_name), agent_id, source
+    if zipfile.is_zipfile(source):
+        extract_dir = tempfile.mkdtemp(prefix='agent_structure_package_')
+        try:
+            with zipfile.ZipFile(source) as package:
+                package.extractall(extract_dir)
+            agent_data = read_local_snapshot(extract_dir)
+        finally:
+            shutil.rmtree(extract_dir, ignore_errors=True)
+    else:
+        agent_data = read_local_snapshot(source)
+    return agent_data, snapshot_agent_id(agent_data, source), source
+
+
+def snapshot_agent_id(agent_data, source):
+    """Agent ID of the first table with rows; a snapshot without any rows
+    has nothing to normalise or diff against"""
+    for table in agent_data.values():
+        if 'agentId' in table and len(table):
+            return table['agentId'].iloc[0]
+    raise ValueError(f"No agent structure rows in {source}")
+
+
+def write_package(path, package_path):
+    """Zip a local sink snapshot directory into a single package file"""
+    path = snapshot_dir(path)
+    with zipfile.ZipFile(package_path, 'w', zipfile.ZIP_DEFLATED) as package:
+        for root, _, files in os.walk(path):
+            for name in files:
+                full_path = os.path.join(root, name)
+                package.write(full_path, os.path.relpath(full_path, path))
+    return package_path
+
+
+def index_table(table, key_columns, agent_id):
+    """Map each row's key to its normalised row. Rows sharing a key (e.g. a
+    phrase repeated in an intent) get an occurrence number appended."""
+    rows = {}
+    occurrences = defaultdict(int)
+    for chunk in iter_frames(table):
+        for row in chunk.to_dict('records'):
+            normalized = normalize_row(row, agent_id)
+            key = tuple(normalized.get(column) for column in key_columns)
+            occurrence = occurrences[key]
+            occurrences[key] += 1
+            rows[key + (occurrence,) if occurrence else key] = normalized
+    return rows
+
+
+def format_key(key):
+    return ' | '.join(str(part) for part in key if part is not None)
+
+
+def format_value(value):
+    if isinstance(value, str) or value is None:
+        return value
+    return json.dumps(value, default=str)
+
+
+def diff_snapshots(old_data, new_data, old_agent_id, new_agent_id):
+    """Return a DataFrame of changes: table, key, change (added, removed or
+    modified), field, oldValue, newValue. Resource paths are compared with
+    each snapshot's own agent prefix removed, so two environments of the same
+    agent can be diffed too."""
+    changes = {'table': [], 'key': [], 'change': [],
+               'field': [], 'oldValue': [], 'newValue': []}
+
+    def record(table_name, key, change, field=None, old=None, new=None):
+        changes['table'].append(table_name)
+        changes['key'].append(format_key(key))
+        changes['change'].append(change)
+        changes['field'].append(field)
+        changes['oldValue'].append(format_value(old))
+        changes['newValue'].append(format_value(new))
+
+    for table_name, key_columns in TABLE_KEYS.items():
+        old_rows = index_table(old_data.get(
+            table_name, pd.DataFrame()), key_columns, old_agent_id)
+        new_rows = index_table(new_data.get(
+            table_name, pd.DataFrame()), key_columns, new_agent_id)
+        for key, old_row in old_rows.items():
+            new_row = new_rows.get(key)
+            if new_row is None:
+                record(table_name, key, 'removed')
+            elif new_row != old_row:
+                for field in sorted(set(old_row) | set(new_row)):
+                    if old_row.get(field) != new_row.get(field):
+                        record(table_name, key, 'modified', field,
+                               old_row.get(field), new_row.get(field))
+        for key in new_rows:
+            if key not in old_rows:
+                record(table_name, key, 'added')
+    return pd.DataFrame(changes)
+
+
+def summarize(diff_df):
+    """Added/removed/modified resource counts per table"""
+    summary = []
+    for table_name in TABLE_KEYS:
+        table_diff = diff_df[diff_df['table'] == table_name]
+        summary.append([table_name] + [
+            table_diff[table_diff['change'] == change]['key'].nunique()
+            for change in ('added', 'removed', 'modified')])
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    diff_parser = commands.add_parser('diff', help='diff two snapshots')
+    source_help = 'live:<agent path>, snapshot directory or package'
+    diff_parser.add_argument('old', help=source_help)
+    diff_parser.add_argument('new', help=source_help)
+    diff_parser.add_argument('--output',
+                             help='write the full diff to this CSV file')
+    diff_parser.add_argument('--details', action='store_true',
+                             help='print every changed field, not just the '
+                                  'summary')
+    package_parser = commands.add_parser(
+        'package', help='zip a local snapshot directory')
+    package_parser.add_argument('snapshot',
+                                help='snapshot (or agent) directory')
+    package_parser.add_argument('package', help='zip file to write')
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    args = parse_args(argv)
+    if args.command == 'package':
+        print(f"Wrote {write_package(args.snapshot, args.package)}")
+        return 0
+
+    old_data = new_data = None
+    try:
+        old_data, old_agent_id, old_label = load_snapshot(args.old)
+        new_data, new_agent_id, new_label = load_snapshot(args.new)
+        diff_df = diff_snapshots(old_data, new_data, old_agent_id,
+                                 new_agent_id)
+    finally:
+        # Live snapshots may have spilled tables to temporary files
+        for agent_data in (old_data, new_data):
+            if agent_data is not None:
+                cleanup_spilled(agent_data)
+    print(f"Changes from {old_label} to {new_label}")
+    print(tabulate(summarize(diff_df),
+                   headers=['table', 'added', 'removed', 'modified']))
+    if args.details and len(diff_df):
+        print(tabulate(diff_df.fillna('').values.tolist(),
+                       headers=list(diff_df.columns)))
+    if args.output:
+        diff_df.to_csv(args.output, index=False)
+        print(f"Wrote {len(diff_df)} changes to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,285 @@
+"""
+Typed schemas of the agent structure tables
+
+One declarative registry, keyed like agent_data, that the tables are built
+from and written with. Rows are collected as plain Python values in the
+registry's column order (raw_frame) and typed once per table or spill chunk
+(coerce): DATETIME columns become datetime64, BOOLEAN/INTEGER the nullable
+pandas types, STRING the Arrow-backed string dtype, ids repeated across many
+rows categoricals and REPEATED columns lists. The same registry gives the full
+BigQuery schema (bq_schema) and the Parquet schema (parquet_schema).
+"""
+
+from collections import namedtuple
+
+import pandas as pd
+import pyarrow as pa
+
+# category: store as a pandas categorical (ids/names repeated across rows)
+Column = namedtuple('Column', ['name', 'type', 'mode', 'category'])
+
+
+def column(name, bq_type='STRING', repeated=False, category=False):
+    mode = 'REPEATED' if repeated else 'NULLABLE'
+    return Column(name, bq_type, mode, category)
+
+
+def snapshot_columns():
+    return [column('date', 'DATETIME'), column('agentId', category=True),
+            column('agentName', category=True)]
+
+
+def flow_columns():
+    return [column('flowId', category=True), column('flowName', category=True)]
+
+
+def fulfillment_columns():
+    return [
+        column('webhookId', category=True),
+        column('webhookName', category=True),
+        column('webhookTag'),
+        column('fulfillment', repeated=True),
+        column('partialResponse', 'BOOLEAN'),
+        column('parameterPresets', repeated=True),
+    ]
+
+
+TABLE_SCHEMAS = {
+    'Intents': snapshot_columns() + [
+        column('intentId'),
+        column('intentName'),
+        column('description'),
+        column('parameters', repeated=True),
+        column('labels', repeated=True),
+    ],
+    'TrainingPhrases': snapshot_columns() + [
+        column('intentId', category=True),
+        column('intentName', category=True),
+        column('phrase'),
+        column('annotatedPhrase'),
+    ],
+    'Entities': snapshot_columns() + [
+        column('entityTypeId', category=True),
+        column('entityTypeName', category=True),
+        column('entity', category=True),
+        column('synonym'),
+    ],
+    'Webhooks': snapshot_columns() + [
+        column('webhookId'),
+        column('webhookName'),
+        column('timeout'),
+        column('serviceDirectory'),
+        column('url'),
+    ],
+    'Pages': snapshot_columns() + flow_columns() + [
+        column('pageId'),
+        column('pageName'),
+    ] + fulfillment_columns() + [
+        column('parameters', repeated=True),
+        column('routes', repeated=True),
+        column('routeGroups', repeated=True),
+    ],
+    'Flows': snapshot_columns() + [
+        column('flowId'),
+        column('flowName'),
+        column('pages', repeated=True),
+    ],
+    'TransitionRoutes': snapshot_columns() + flow_columns() + [
+        column('pageId', category=True),
+        column('pageName', category=True),
+        column('transitionRouteId'),
+        column('routeGroupId', category=True),
+        column('routeGroupName', category=True),
+        column('intentId', category=True),
+        column('intentName', category=True),
+        column('parameterId', category=True),
+        column('parameterName', category=True),
+        column('targetPageId', category=True),
+        column('targetPageName', category=True),
+        column('webhookId', category=True),
+        column('webhookName', category=True),
+        column('webhookTag'),
+        column('event', category=True),
+        column('condition'),
+        column('fulfillment', repeated=True),
+        column('partialResponse', 'BOOLEAN'),
+        column('parameterPresets', repeated=True),
+    ],
+    'RouteGroups': snapshot_columns() + flow_columns() + [
+        column('routeGroupId'),
+        column('routeGroupName'),
+        column('routes', repeated=True),
+    ],
+    'Parameters': snapshot_columns() + flow_columns() + [
+        column('pageId', category=True),
+        column('pageName', category=True),
+        column('parameterId'),
+        column('parameterName'),
+        column('entityId', category=True),
+        column('entityName', category=True),
+        column('webhookId', category=True),
+        column('webhookName', category=True),
+        column('webhookTag'),
+        column('required', 'BOOLEAN'),
+        column('isList', 'BOOLEAN'),
+        column('redactInLog', 'BOOLEAN'),
+        column('fulfillment', repeated=True),
+        column('partialResponse', 'BOOLEAN'),
+        column('parameterPresets', repeated=True),
+        column('routes', repeated=True),
+    ],
+    'PageGraph': snapshot_columns() + [
+        column('flowId', category=True),
+        column('pageId'),
+        column('pageName'),
+        column('targetPageIds', repeated=True),
+        column('inDegree', 'INTEGER'),
+        column('outDegree', 'INTEGER'),
+        column('reachable', 'BOOLEAN'),
+        column('reachesEndSession', 'BOOLEAN'),
+        column('isDeadEnd', 'BOOLEAN'),
+        column('componentId', 'INTEGER'),
+        column('componentSize', 'INTEGER'),
+        column('inLoop', 'BOOLEAN'),
+    ],
+    'FlowGraph': snapshot_columns() + [
+        column('flowId'),
+        column('flowName'),
+        column('targetFlowIds', repeated=True),
+        column('reachable', 'BOOLEAN'),
+        column('reachesEndSession', 'BOOLEAN'),
+        column('deadEndPages', 'INTEGER'),
+        column('componentId', 'INTEGER'),
+        column('inLoop', 'BOOLEAN'),
+    ],
+    'References': snapshot_columns() + [
+        column('referencedType', category=True),
+        column('referencedId', category=True),
+        column('referencedName', category=True),
+        column('referrerType', category=True),
+        column('referrerId'),
+        column('parentId', category=True),
+        column('flowId', category=True),
+        column('count', 'INTEGER'),
+    ],
+    'TextTerms': snapshot_columns() + [
+        column('term', category=True),
+        column('docType', category=True),
+        column('docId', category=True),
+        column('parentId', category=True),
+        column('flowId', category=True),
+        column('positions', 'INTEGER', repeated=True),
+    ],
+    'RunReport': [
+        column('stage'),
+        column('seconds', 'FLOAT'),
+        column('peakTracedMb', 'FLOAT'),
+        column('peakRssMb', 'FLOAT'),
+        column('endRssMb', 'FLOAT'),
+        column('spilledBatches', 'INTEGER'),
+    ],
+    # Content-addressed storage mode
+    'Objects': [
+        column('contentHash'),
+        column('tableName', category=True),
+        column('content'),
+        column('date', 'DATETIME'),
+    ],
+    'ObjectMembership': [
+        column('date', 'DATETIME'),
+        column('agentId', category=True),
+        column('agentName', category=True),
+        column('tableName', category=True),
+        column('objectKey'),
+        column('contentHash'),
+    ],
+}
+
+PANDAS_TYPES = {
+    'DATETIME': 'datetime64[us]',
+    'STRING': pd.StringDtype('pyarrow'),
+    'BOOLEAN': 'boolean',
+    'INTEGER': 'Int64',
+    'FLOAT': 'float64',
+}
+ARROW_TYPES = {
+    'DATETIME': pa.timestamp('us'),
+    'STRING': pa.string(),
+    'BOOLEAN': pa.bool_(),
+    'INTEGER': pa.int64(),
+    'FLOAT': pa.float64(),
+}
+
+
+def columns(table):
+    return [col.name for col in TABLE_SCHEMAS[table]]
+
+
+def raw_frame(table, data=None):
+    """Untyped frame with the table's columns from a dict of columns or a
+    list of row dicts; cheap enough for small per-page batches"""
+    return pd.DataFrame(data if data is not None else [],
+                        columns=columns(table))
+
+
+def coerce(table, df):
+    """Give every column of df its registry type (in place, returns df)"""
+    for col in TABLE_SCHEMAS[table]:
+        if col.mode == 'REPEATED':
+            # An explicit object Series: a plain (possibly empty) list would
+            # become float64, which Parquet can't write as a list column
+            df[col.name] = pd.Series(
+                [value if isinstance(value, list) else []
+                 for value in df[col.name]],
+                index=df.index, dtype=object)
+            continue
+        dtype = 'category' if col.category else PANDAS_TYPES[col.type]
+        if df[col.name].dtype != dtype:
+            df[col.name] = df[col.name].astype(dtype)
+    return df
+
+
+def present(value):
+    """Unset scrapi/proto string fields come back as None, '' or NaN"""
+    return isinstance(value, str) and value != ''
+
+
+def route_parent(route):
+    """The parameter, page or route group (first one set) a TransitionRoutes
+    row belongs to"""
+    parents = (route.parameterId, route.pageId, route.routeGroupId)
+    return next((parent for parent in parents if present(parent)), None)
+
+
+def build_frame(table, data=None):
+    return coerce(table, raw_frame(table, data))
+
+
+def concat_frames(table, frames):
+    """Concatenate batches of one table; categories differ between batches,
+    so the result is typed again"""
+    if not frames:
+        return build_frame(table)
+    return coerce(table, pd.concat(frames))
+
+
+def preparer(table):
+    """SpillableTable prepare hook typing each concatenated chunk"""
+    return lambda chunk: coerce(table, chunk)
+
+
+def bq_schema(table):
+    return [{"name": col.name, "type": col.type, "mode": col.mode}
+            for col in TABLE_SCHEMAS[table]]
+
+
+def parquet_schema(table):
+    fields = []
+    for col in TABLE_SCHEMAS[table]:
+        arrow_type = ARROW_TYPES[col.type]
+        if col.category:
+            arrow_type = pa.dictionary(pa.int32(), arrow_type)
+        if col.mode == 'REPEATED':
+            arrow_type = pa.list_(arrow_type)
+        fields.append(pa.field(col.name, arrow_type))
+    return pa.schema(fields)
@@ -0,0 +1,174 @@
+"""Tests for rate_limit against a fake scrapi client that injects errors"""
+
+import grpc
+import pytest
+from google.api_core import exceptions as core_exceptions
+from google.api_core.gapic_v1 import method as gapic_method
+from google.cloud.dialogflowcx_v3beta1.services.pages import PagesClient
+from google.cloud.dialogflowcx_v3beta1.services.pages.transports.grpc import (
+    PagesGrpcTransport)
+from google.cloud.dialogflowcx_v3beta1.types import page as page_types
+
+from rate_limit import RPC_HOOK_INSTALLED, RateLimiter, ThrottledClient
+
+FLOW = 'projects/p/locations/global/agents/a/flows/f'
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class ListPagesRpc(grpc.UnaryUnaryMultiCallable):
+    """Answers ListPages with one page per request until result_pages"""
+
+    def __init__(self, result_pages):
+        self.result_pages = result_pages
+
+    def __call__(self, request, **kwargs):
+        number = int(request.page_token or 0)
+        more = number + 1 < self.result_pages
+        return page_types.ListPagesResponse(
+            pages=[page_types.Page(name=f"{FLOW}/pages/{number}")],
+            next_page_token=str(number + 1) if more else '')
+
+    def with_call(self, request, **kwargs):
+        return self(request), None
+
+    def future(self, request, **kwargs):
+        raise NotImplementedError
+
+
+class FakeChannel(grpc.Channel):
+    """In-process channel, so a real DFCX PagesClient (and transport) can
+    run without a server"""
+
+    def __init__(self, result_pages):
+        self.result_pages = result_pages
+
+    def unary_unary(self, method, *args, **kwargs):
+        return ListPagesRpc(self.result_pages)
+
+    def unary_stream(self, method, *args, **kwargs):
+        raise NotImplementedError
+
+    def stream_unary(self, method, *args, **kwargs):
+        raise NotImplementedError
+
+    def stream_stream(self, method, *args, **kwargs):
+        raise NotImplementedError
+
+    def subscribe(self, callback, try_to_connect=False):
+        pass
+
+    def unsubscribe(self, callback):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeClient:
+    """Raises the queued errors in order, then returns 'ok'. list_pages pages
+    through its results with a real PagesClient, one RPC per result page."""
+
+    def __init__(self, errors=(), result_pages=1):
+        self.errors = list(errors)
+        self.calls = 0
+        self.pages_client = PagesClient(
+            transport=PagesGrpcTransport(channel=FakeChannel(result_pages)))
+
+    def get_agent(self, agent_id=None):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+    def list_pages(self, flow_id=None):
+        return [page.name.split('/')[-1]
+                for page in self.pages_client.list_pages(parent=flow_id)]
+
+
+def make_limiter(reads_per_minute=600, max_retries=3):
+    clock = FakeClock()
+    limiter = RateLimiter(reads_per_minute, max_retries=max_retries,
+                          clock=clock, sleep=clock.sleep, rand=lambda: 1.0)
+    return limiter, clock
+
+
+def test_retries_quota_errors_and_cuts_rate():
+    limiter, clock = make_limiter()
+    client = FakeClient([core_exceptions.ResourceExhausted('quota'),
+                         core_exceptions.ResourceExhausted('quota')])
+    assert ThrottledClient(client, limiter).get_agent() == 'ok'
+    assert client.calls == 3
+    assert limiter.stats['retries'] == 2
+    assert limiter.stats['failures'] == 0
+    # Full jitter with rand() == 1 sleeps the whole capped delay: 1s, 2s
+    assert clock.sleeps == [1.0, 2.0]
+    assert limiter.bucket.rate < limiter.bucket.max_rate
+
+
+def test_unavailable_gives_up_after_max_retries():
+    limiter, _ = make_limiter(max_retries=2)
+    client = FakeClient(
+        [core_exceptions.ServiceUnavailable('down') for _ in range(5)])
+    with pytest.raises(core_exceptions.ServiceUnavailable):
+        ThrottledClient(client, limiter).get_agent()
+    assert client.calls == 3
+    assert limiter.stats['failures'] == 1
+    # Only quota errors slow the bucket down
+    assert limiter.bucket.rate == limiter.bucket.max_rate
+
+
+def test_other_errors_are_not_retried():
+    limiter, _ = make_limiter()
+    client = FakeClient([core_exceptions.NotFound('gone')])
+    with pytest.raises(core_exceptions.NotFound):
+        ThrottledClient(client, limiter).get_agent()
+    assert client.calls == 1
+    assert limiter.stats['retries'] == 0
+
+
+def test_calls_wait_for_tokens():
+    limiter, clock = make_limiter(reads_per_minute=60)
+    client = ThrottledClient(FakeClient(), limiter)
+    for _ in range(3):
+        client.get_agent()
+    # Capacity of one token at one token per second
+    assert limiter.stats['throttle_waits'] == 2
+    assert clock.now == pytest.approx(2.0)
+
+
+def test_rpc_hook_is_installed():
+    # Fails when a google-cloud-dialogflow-cx upgrade drops the private
+    # transport hooks rate_limit relies on
+    assert RPC_HOOK_INSTALLED
+
+
+def test_every_rpc_of_a_paged_call_takes_a_token():
+    limiter, clock = make_limiter(reads_per_minute=60)
+    client = ThrottledClient(FakeClient(result_pages=3), limiter)
+    assert client.list_pages(flow_id=FLOW) == ['0', '1', '2']
+    assert limiter.stats['calls'] == 1
+    assert limiter.stats['rpcs'] == 3
+    assert clock.now == pytest.approx(2.0)
+    # RPCs outside a throttled call are not charged
+    FakeClient().list_pages(flow_id=FLOW)
+    assert limiter.stats['rpcs'] == 3
+
+
+def test_only_dfcx_rpcs_are_counted():
+    limiter, _ = make_limiter()
+    # Any other GAPIC method (BigQuery, Storage, ...) is left alone
+    other_rpc = gapic_method.wrap_method(lambda request, **kwargs: request)
+    assert limiter.call(other_rpc, 'request') == 'request'
+    assert limiter.stats['rpcs'] == 0
@@ -0,0 +1,16 @@
+"""Tests for the table_schemas registry"""
+
+import pyarrow.parquet as pq
+import pytest
+
+from table_schemas import (TABLE_SCHEMAS, build_frame, concat_frames,
+                           parquet_schema)
+
+
+@pytest.mark.parametrize('table', sorted(TABLE_SCHEMAS))
+def test_empty_frames_write_to_parquet(table, tmp_path):
+    path = tmp_path / f"{table}.parquet"
+    for frame in (build_frame(table), concat_frames(table, [])):
+        frame.to_parquet(path, index=False, schema=parquet_schema(table))
+        assert pq.read_schema(path).equals(parquet_schema(table),
+                                           check_metadata=False)
@@ -0,0 +1,43 @@
+"""Tests for the text index"""
+
+import json
+
+from text_index import TextIndex, fulfillment_texts
+
+CONDITIONAL = ('if $session.params.tier = "gold"\n'
+               '  Welcome back, gold member\n'
+               'elif $session.params.tier = "silver"\n'
+               '  Welcome back\n'
+               'else\n'
+               '  Hello there\n')
+SSML = '<speak>Say <emphasis level="strong">hello</emphasis> &amp; bye</speak>'
+
+
+def messages(*pairs):
+    return [json.dumps({'type': message_type, 'data': data})
+            for message_type, data in pairs]
+
+
+def test_conditional_responses_index_only_case_messages():
+    texts = fulfillment_texts(messages(('Conditional response', CONDITIONAL)))
+    assert texts == ['Welcome back, gold member', 'Welcome back',
+                     'Hello there']
+
+
+def test_ssml_tags_are_not_indexed():
+    texts = fulfillment_texts(messages(('Output audio text', SSML),
+                                       ('Custom payload', {'a': 'b'})))
+    assert texts[0].split() == ['Say', 'hello', '&', 'bye']
+    assert len(texts) == 1
+
+
+def test_phrases_do_not_span_conditions_or_markup():
+    index = TextIndex()
+    for text in fulfillment_texts(messages(('Conditional response',
+                                            CONDITIONAL),
+                                           ('Output audio text', SSML))):
+        index.add_text('route', 'r1', text)
+    assert index.search('session params tier') == []
+    assert index.search('emphasis') == []
+    assert index.phrase('gold member welcome') == []
+    assert len(index.phrase('say hello bye')) == 1
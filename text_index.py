@@ -0,0 +1,268 @@
+"""
+Inverted text index over fulfillments and training phrases
+
+Built during load_agent_data (when enabled) from the same fulfillment JSON
+strings and training phrases written to the tables. Maps normalised terms to
+the routes, pages, parameters and intents containing them, with positions for
+phrase queries and a sorted vocabulary for prefix queries. Persisted as the
+narrow text_index table (one row per term and document), which from_table
+turns back into an index for local queries:
+
+    python text_index.py out/<agent>/<snapshot> "talk to an agent" --phrase
+    python text_index.py out/<agent>/<snapshot> refund --prefix
+"""
+
+import argparse
+import bisect
+import html
+import json
+import os
+import re
+import sys
+import unicodedata
+from collections import defaultdict
+
+import pandas as pd
+from tabulate import tabulate
+
+from memory_budget import restore_lists
+from table_schemas import route_parent
+
+DEFAULT_ENABLED = os.environ.get(
+    'BUILD_TEXT_INDEX', '').lower() in ('1', 'true', 'yes')
+TOKEN = re.compile(r'\w+')
+# Position gap between separate texts of one document, so phrases never match
+# across two messages or two training phrases
+TEXT_GAP = 1
+# Fulfillment message types whose data is text shown/spoken to the user
+TEXT_MESSAGE_TYPES = ('Agent says', 'Conditional response',
+                      'Output audio text')
+# Unindented if/elif/else lines of a parse_conditional_fulfillment string hold
+# condition expressions; the case messages are the indented lines
+CONDITION_LINE = re.compile(r'(?:if|elif)\b|else$')
+SSML_TAG = re.compile(r'<[^>]*>')
+
+ROUTE = 'route'
+PAGE = 'page'
+PARAMETER = 'parameter'
+INTENT = 'intent'
+
+
+def normalize(text):
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def tokenize(text):
+    return TOKEN.findall(normalize(text))
+
+
+def conditional_texts(text):
+    """Case messages of a conditional response, one text per line"""
+    return [line.strip() for line in text.splitlines()
+            if line.strip()
+            and (line[0].isspace() or not CONDITION_LINE.match(line))]
+
+
+def ssml_texts(ssml):
+    return [html.unescape(SSML_TAG.sub(' ', ssml))]
+
+
+def fulfillment_texts(messages):
+    """Text from parse_fulfillment's JSON message strings, without
+    conditions or SSML markup"""
+    texts = []
+    for message in messages:
+        message = json.loads(message)
+        if message['type'] not in TEXT_MESSAGE_TYPES:
+            continue
+        data = message['data']
+        if message['type'] == 'Conditional response':
+            texts.extend(conditional_texts(data))
+        elif message['type'] == 'Output audio text':
+            texts.extend(ssml_texts(data))
+        else:
+            texts.extend(data if isinstance(data, list) else [data])
+    return [text for text in texts if isinstance(text, str)]
+
+
+class TextIndex:
+    def __init__(self):
+        self.docs = []  # doc number -> (doc type, doc ID, parent ID, flow ID)
+        self.doc_numbers = {}
+        self.doc_lengths = []  # next free position per doc
+        self.postings = defaultdict(dict)  # term -> {doc number: [positions]}
+        self._vocabulary = None
+
+    def _doc_number(self, doc):
+        if doc not in self.doc_numbers:
+            self.doc_numbers[doc] = len(self.docs)
+            self.docs.append(doc)
+            self.doc_lengths.append(0)
+        return self.doc_numbers[doc]
+
+    def add_text(self, doc_type, doc_id, text, parent_id=None, flow_id=None):
+        doc = self._doc_number((doc_type, doc_id, parent_id, flow_id))
+        start = self.doc_lengths[doc]
+        tokens = tokenize(text)
+        for offset, term in enumerate(tokens):
+            self.postings[term].setdefault(doc, []).append(start + offset)
+        self.doc_lengths[doc] = start + len(tokens) + TEXT_GAP
+        self._vocabulary = None
+
+    def add_routes(self, routes):
+        columns = ['flowId', 'pageId', 'routeGroupId', 'parameterId',
+                   'transitionRouteId', 'fulfillment']
+        for row in routes[columns].itertuples(index=False):
+            parent_id = route_parent(row)
+            for text in fulfillment_texts(row.fulfillment):
+                self.add_text(ROUTE, row.transitionRouteId,
+                              text, parent_id, row.flowId)
+
+    def add_pages(self, pages):
+        columns = ['flowId', 'pageId', 'fulfillment']
+        for row in pages[columns].itertuples(index=False):
+            for text in fulfillment_texts(row.fulfillment):
+                self.add_text(PAGE, row.pageId, text, flow_id=row.flowId)
+
+    def add_parameters(self, parameters):
+        columns = ['flowId', 'pageId', 'parameterId', 'fulfillment']
+        for row in parameters[columns].itertuples(index=False):
+            for text in fulfillment_texts(row.fulfillment):
+                self.add_text(PARAMETER, row.parameterId,
+                              text, row.pageId, row.flowId)
+
+    def add_training_phrases(self, training_phrases):
+        for intent_id, phrase in zip(training_phrases['intentId'],
+                                     training_phrases['phrase']):
+            self.add_text(INTENT, intent_id, phrase)
+
+    @property
+    def vocabulary(self):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        return self._vocabulary
+
+    def _results(self, doc_numbers):
+        fields = ('docType', 'docId', 'parentId', 'flowId')
+        return [dict(zip(fields, self.docs[doc]))
+                for doc in sorted(doc_numbers)]
+
+    def search(self, query):
+        """Documents containing every term of query, in any order"""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        # Intersect starting from the rarest term
+        terms.sort(key=lambda term: len(self.postings.get(term, ())))
+        docs = set(self.postings.get(terms[0], ()))
+        for term in terms[1:]:
+            docs.intersection_update(self.postings.get(term, ()))
+        return self._results(docs)
+
+    def phrase(self, query):
+        """Documents containing the terms of query consecutively"""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        candidates = set(self.postings.get(terms[0], ()))
+        for term in terms[1:]:
+            candidates.intersection_update(self.postings.get(term, ()))
+        matches = []
+        for doc in candidates:
+            starts = set(self.postings[terms[0]][doc])
+            for i, term in enumerate(terms[1:], 1):
+                starts.intersection_update(
+                    position - i for position in self.postings[term][doc])
+                if not starts:
+                    break
+            if starts:
+                matches.append(doc)
+        return self._results(matches)
+
+    def prefix(self, prefix):
+        """Documents containing any term starting with prefix"""
+        prefix = normalize(prefix)
+        vocabulary = self.vocabulary
+        docs = set()
+        i = bisect.bisect_left(vocabulary, prefix)
+        while i < len(vocabulary) and vocabulary[i].startswith(prefix):
+            docs.update(self.postings[vocabulary[i]])
+            i += 1
+        return self._results(docs)
+
+    def to_table(self, date, agent_id, agent_name):
+        """Return the text_index table as a dict of columns, one row per term
+        and document"""
+        table = {column: [] for column in (
+            'date', 'agentId', 'agentName', 'term', 'docType', 'docId',
+            'parentId', 'flowId', 'positions')}
+        for term in self.vocabulary:
+            for doc, positions in self.postings[term].items():
+                doc_type, doc_id, parent_id, flow_id = self.docs[doc]
+                table['date'].append(date)
+                table['agentId'].append(agent_id)
+                table['agentName'].append(agent_name)
+                table['term'].append(term)
+                table['docType'].append(doc_type)
+                table['docId'].append(doc_id)
+                table['parentId'].append(parent_id)
+                table['flowId'].append(flow_id)
+                table['positions'].append(positions)
+        return table
+
+    @classmethod
+    def from_table(cls, table):
+        index = cls()
+        columns = ['term', 'docType', 'docId', 'parentId', 'flowId',
+                   'positions']
+        for row in table[columns].itertuples(index=False):
+            parent_id = row.parentId if isinstance(row.parentId, str) else None
+            flow_id = row.flowId if isinstance(row.flowId, str) else None
+            doc = index._doc_number(
+                (row.docType, row.docId, parent_id, flow_id))
+            index.postings[row.term][doc] = list(row.positions)
+        return index
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Query the text index of a local snapshot')
+    parser.add_argument('snapshot',
+                        help='local sink snapshot (or agent) directory')
+    parser.add_argument('query')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--phrase', action='store_true',
+                      help='match the words consecutively')
+    mode.add_argument('--prefix', action='store_true',
+                      help='match terms starting with query')
+    return parser.parse_args(argv)
+
+
+def cli(argv=None):
+    # snapshot_diff imports main, which imports this module
+    from snapshot_diff import snapshot_dir
+
+    args = parse_args(argv)
+    table_dir = os.path.join(snapshot_dir(args.snapshot), 'text_index')
+    if not os.path.isdir(table_dir):
+        print(f"Error: no text_index table in {args.snapshot} "
+              "(extract with BUILD_TEXT_INDEX=1)")
+        return 2
+    table = pd.concat([
+        restore_lists(pd.read_parquet(os.path.join(table_dir, part)))
+        for part in sorted(os.listdir(table_dir))])
+    index = TextIndex.from_table(table)
+    if args.phrase:
+        results = index.phrase(args.query)
+    elif args.prefix:
+        results = index.prefix(args.query)
+    else:
+        results = index.search(args.query)
+    print(tabulate([list(result.values()) for result in results],
+                   headers=['docType', 'docId', 'parentId', 'flowId']))
+    print(f"{len(results)} matches")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
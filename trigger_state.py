@@ -0,0 +1,282 @@
+"""
+Coalescing of extraction triggers
+
+Agents are de-duplicated within a Pub/Sub message, and an agent whose
+structure was captured (or is being captured) within the coalescing window is
+skipped. Capture times, leases and agent fingerprints live in a state store,
+chosen by the TRIGGER_STATE_STORE setting (never by message data):
+
+* memory      - per-process (survives warm Cloud Function invocations)
+* file:<path> - JSON file, locked so several local processes can share it
+* bigquery    - agent_structure.extraction_state in the agent's BQ project,
+                shared by every instance; leases are taken with a MERGE
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from google.api_core import exceptions as core_exceptions
+from google.cloud import bigquery
+
+DEFAULT_WINDOW_SECONDS = float(os.environ.get('COALESCE_WINDOW_SECONDS', 300))
+DEFAULT_STATE_STORE = os.environ.get('TRIGGER_STATE_STORE', 'memory')
+DEFAULT_PRECHECK = os.environ.get(
+    'EXTRACTION_PRECHECK', '').lower() in ('1', 'true', 'yes')
+# An in-flight lease stops overlapping triggers; it expires in case the
+# extraction that took it died without releasing it
+LEASE_SECONDS = float(os.environ.get('EXTRACTION_LEASE_SECONDS', 1800))
+
+
+def agent_key(agent):
+    """Key of a message entry: the agent and where its structure is written"""
+    full_agent_path = (f"projects/{agent['agent_project_id']}"
+                       f"/locations/{agent['agent_location']}"
+                       f"/agents/{agent['agent_id']}")
+    return f"{agent['bq_project_id']}|{full_agent_path}"
+
+
+def dedupe_agents(message_data):
+    """Drop repeated agents from a message, keeping the first occurrence"""
+    seen = set()
+    unique = []
+    for agent in message_data:
+        key = agent_key(agent)
+        if key in seen:
+            print(f"Skipping duplicate trigger for {key}")
+            continue
+        seen.add(key)
+        unique.append(agent)
+    return unique
+
+
+def agent_fingerprint(agent, flows, pages, route_groups, intents,
+                      entity_types, webhooks):
+    """Hash of everything the extraction reads: the agent settings, flows,
+    pages and route groups (dicts of flow name -> list), intents (with their
+    training phrases), entity types and webhooks. Much cheaper to fetch than a
+    full extraction and changes whenever any of them is edited."""
+    digest = hashlib.sha256()
+
+    def add(resources):
+        for resource in sorted(resources, key=lambda r: r.name):
+            digest.update(type(resource).to_json(
+                resource, sort_keys=True).encode('utf-8'))
+
+    add([agent])
+    for flow in sorted(flows, key=lambda f: f.name):
+        add([flow])
+        add(pages.get(flow.name, []))
+        add(route_groups.get(flow.name, []))
+    add(intents)
+    add(entity_types)
+    add(webhooks)
+    return digest.hexdigest()
+
+
+class MemoryStateStore:
+    """Per-process store, and the dict-backed base of FileStateStore.
+    Records are dicts with capturedAt, leasedUntil and fingerprint, read and
+    written only while locked() is held. Every store implements acquire,
+    release, abandon and fingerprint."""
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            yield
+
+    def acquire(self, key, window, now=None):
+        """Take the extraction lease for key unless it was captured within
+        window seconds or another extraction holds the lease"""
+        now = time.time() if now is None else now
+        with self.locked():
+            record = self.records.get(key, {})
+            captured_at = record.get('capturedAt')
+            if captured_at is not None and now - captured_at < window:
+                return False
+            leased_until = record.get('leasedUntil')
+            if leased_until is not None and now < leased_until:
+                return False
+            self.records[key] = dict(
+                record, leasedUntil=now + LEASE_SECONDS)
+            return True
+
+    def release(self, key, fingerprint=None, now=None):
+        """Record a completed capture and drop the lease"""
+        now = time.time() if now is None else now
+        with self.locked():
+            record = self.records.get(key, {})
+            fingerprint = fingerprint or record.get('fingerprint')
+            self.records[key] = dict(record, capturedAt=now,
+                                     leasedUntil=None, fingerprint=fingerprint)
+
+    def abandon(self, key):
+        """Drop the lease without recording a capture"""
+        with self.locked():
+            record = self.records.get(key, {})
+            self.records[key] = dict(record, leasedUntil=None)
+
+    def fingerprint(self, key):
+        with self.locked():
+            return self.records.get(key, {}).get('fingerprint')
+
+
+class FileStateStore(MemoryStateStore):
+    """Records in a JSON file, loaded and saved under an exclusive file lock
+    so several local processes can share it"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.records = None  # Loaded while the file lock is held
+
+    @contextmanager
+    def locked(self):
+        with self.lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                self.records = json.loads(content) if content else {}
+                yield
+                f.seek(0)
+                f.truncate()
+                json.dump(self.records, f)
+            finally:
+                self.records = None
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class BigQueryStateStore:
+    """One row per agent in agent_structure.extraction_state, shared by all
+    function instances. A lease is taken with a conditional MERGE: BigQuery
+    serialises mutating DML on a table, so of two overlapping triggers only
+    one updates (or inserts) the row; a concurrent-update error is treated
+    as losing the race."""
+
+    table_id = 'agent_structure.extraction_state'
+    _ready = set()  # Projects whose state table is known to exist
+
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self.client = bigquery.Client(project=project_id)
+        self.leases = {}  # key -> lease ID taken by this instance
+
+    def query(self, sql, **params):
+        types = {str: 'STRING', float: 'FLOAT64', datetime: 'TIMESTAMP'}
+        config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter(
+                name, types[type(value)] if value is not None else 'STRING',
+                value)
+            for name, value in params.items()])
+        job = self.client.query(sql, job_config=config)
+        rows = list(job.result())
+        return job, rows
+
+    def ensure_table(self):
+        if self.project_id in self._ready:
+            return
+        self.query(f"""
+            CREATE TABLE IF NOT EXISTS `{self.table_id}` (
+                stateKey STRING NOT NULL,
+                capturedAt TIMESTAMP,
+                fingerprint STRING,
+                leasedUntil TIMESTAMP,
+                leaseId STRING
+            )
+        """)
+        self._ready.add(self.project_id)
+
+    def fingerprint(self, key):
+        self.ensure_table()
+        _, rows = self.query(f"""
+            SELECT fingerprint
+            FROM `{self.table_id}`
+            WHERE stateKey = @key
+        """, key=key)
+        return rows[0].fingerprint if rows else None
+
+    def acquire(self, key, window, now=None):
+        now = time.time() if now is None else now
+        self.ensure_table()
+        lease_id = uuid.uuid4().hex
+        merge = f"""
+            MERGE `{self.table_id}` T
+            USING (SELECT @key AS stateKey) S
+            ON T.stateKey = S.stateKey
+            WHEN MATCHED
+                AND (T.capturedAt IS NULL
+                     OR T.capturedAt <= @capturedBefore)
+                AND (T.leasedUntil IS NULL OR T.leasedUntil <= @now) THEN
+                UPDATE SET leasedUntil = @leasedUntil, leaseId = @leaseId
+            WHEN NOT MATCHED THEN
+                INSERT (stateKey, leasedUntil, leaseId)
+                VALUES (@key, @leasedUntil, @leaseId)
+        """
+        try:
+            job, _ = self.query(
+                merge, key=key, now=utc(now),
+                capturedBefore=utc(now - window),
+                leasedUntil=utc(now + LEASE_SECONDS), leaseId=lease_id)
+        except core_exceptions.BadRequest as e:
+            if 'concurrent update' not in str(e):
+                raise
+            print(f"Lost the extraction lease race for {key}")
+            return False
+        if not job.num_dml_affected_rows:
+            return False
+        self.leases[key] = lease_id
+        return True
+
+    def release(self, key, fingerprint=None, now=None):
+        now = time.time() if now is None else now
+        update = f"""
+            UPDATE `{self.table_id}`
+            SET capturedAt = @now,
+                fingerprint = COALESCE(@fingerprint, fingerprint),
+                leasedUntil = NULL, leaseId = NULL
+            WHERE stateKey = @key AND leaseId = @leaseId
+        """
+        self.query(update, key=key, now=utc(now), fingerprint=fingerprint,
+                   leaseId=self.leases.pop(key, None))
+
+    def abandon(self, key):
+        self.query(f"""
+            UPDATE `{self.table_id}`
+            SET leasedUntil = NULL, leaseId = NULL
+            WHERE stateKey = @key AND leaseId = @leaseId
+        """, key=key, leaseId=self.leases.pop(key, None))
+
+
+def utc(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc)
+
+
+_memory_store = MemoryStateStore()
+_file_stores = {}
+_bigquery_stores = {}
+
+
+def get_state_store(spec=DEFAULT_STATE_STORE, project_id=None):
+    if spec == 'memory':
+        return _memory_store
+    if spec.startswith('file:'):
+        path = spec[len('file:'):]
+        if path not in _file_stores:
+            _file_stores[path] = FileStateStore(path)
+        return _file_stores[path]
+    if spec == 'bigquery':
+        if project_id not in _bigquery_stores:
+            _bigquery_stores[project_id] = BigQueryStateStore(project_id)
+        return _bigquery_stores[project_id]
+    raise ValueError(f"Unknown trigger state store: {spec}")